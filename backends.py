@@ -0,0 +1,137 @@
+from typing import Dict, Iterable, List, Optional
+import os
+import re
+import json
+import random
+import weakref
+import hashlib
+import asyncio
+import aiohttp
+import openai
+
+
+class Completion:
+    def __init__(self, texts: List[str], usage: Dict[str, int] = None):
+        self.texts: List[str] = texts
+        self.usage: Optional[Dict[str, int]] = usage
+
+
+class Backend:
+    async def complete(self, messages: List[Dict[str, str]], model: str, temperature: float, stop: List[str], **kwargs) -> Completion:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        # releases whatever the backend holds for the running event loop
+        pass
+
+
+class OpenAIBackend(Backend):
+    def __init__(self, api_key: str = None, api_base: str = None):
+        self.api_key: str = api_key or os.environ["OPENAI_API_KEY"]
+        self.api_base: Optional[str] = api_base
+        self.sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession]" = weakref.WeakKeyDictionary()
+
+    def get_session(self) -> aiohttp.ClientSession:
+        # one connection pool per event loop, without it openai opens a new session and connection for every request
+        loop = asyncio.get_running_loop()
+        session = self.sessions.get(loop)
+        if session is None or session.closed:
+            session = self.sessions[loop] = aiohttp.ClientSession()
+        return session
+
+    async def complete(self, messages: List[Dict[str, str]], model: str, temperature: float, stop: List[str], **kwargs) -> Completion:
+        if self.api_base is not None:
+            kwargs["api_base"] = self.api_base
+        token = openai.aiosession.set(self.get_session())
+        try:
+            response = await openai.ChatCompletion.acreate(
+                api_key=self.api_key,
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                stop=stop,
+                **kwargs
+            )
+        finally:
+            openai.aiosession.reset(token)
+        return Completion([choice.message.content for choice in response.choices], getattr(response, "usage", None))
+
+    async def close(self) -> None:
+        session = self.sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+
+class MockBackend(Backend):
+    # an offline backend that answers every prompt of this repo in the format its parsers expect
+    words = ["dance", "date", "friday", "music", "school", "party", "really", "maybe", "think", "great", "honestly",
+             "weekend", "tonight", "homework", "nervous", "fun", "tickets", "together", "sure", "wow"]
+
+    def __init__(self, seed: int = 0, latency: float = 0.0, jitter: float = 0.0, responses: Iterable[str] = None,
+                 yes_rate: float = 0.1):
+        self.seed: int = seed
+        self.latency: float = latency
+        self.jitter: float = jitter
+        self.responses = iter(responses) if responses is not None else None
+        self.yes_rate: float = yes_rate
+        self.calls: int = 0
+        self.seen: Dict[str, int] = {}
+
+    def get_rng(self, messages: List[Dict[str, str]]) -> random.Random:
+        # seeded by the prompt and how often it was asked, so results do not depend on scheduling order
+        key = json.dumps(messages, sort_keys=True)
+        self.seen[key] = self.seen.get(key, 0) + 1
+        digest = hashlib.sha256("{}:{}:{}".format(self.seed, self.seen[key], key).encode("utf-8")).hexdigest()
+        return random.Random(int(digest[:16], 16))
+
+    def sentence(self, rng: random.Random) -> str:
+        return " ".join(rng.choice(self.words) for _ in range(rng.randint(4, 9))).capitalize() + rng.choice([".", "!", "?"])
+
+    def respond(self, messages: List[Dict[str, str]], rng: random.Random) -> str:
+        if self.responses is not None:
+            response = next(self.responses, None)
+            if response is not None:
+                return response
+        system = messages[0]["content"] if messages[0]["role"] == "system" else ""
+        message = messages[-1]["content"]
+        names = re.findall(r"information about (.+?):", system)
+        attitudes = re.search(r"Attitudes: (.+)", message)
+        relations = re.search(r"Relationships: (.+)", message)
+        if "one line per character" in message and attitudes and relations:
+            return "\n".join("{}: New Attitude: {}, New Relationship: {}".format(
+                name, rng.choice(attitudes.group(1).split(", ")), rng.choice(relations.group(1).split(", ")))
+                for name in re.findall(r"^(.+?): New Attitude: attitude from list", message, re.MULTILINE))
+        if "New Attitude" in message and "New Relationship" in message and attitudes and relations:
+            return "New Attitude: {}\nNew Relationship: {}".format(rng.choice(attitudes.group(1).split(", ")), rng.choice(relations.group(1).split(", ")))
+        if "New Attitude" in message and attitudes:
+            return "New Attitude: {}".format(rng.choice(attitudes.group(1).split(", ")))
+        if "New Relationship" in message and relations:
+            return "New Relationship: {}".format(rng.choice(relations.group(1).split(", ")))
+        if "Output yes or no" in message:
+            return "Yes" if rng.random() < self.yes_rate else "No"
+        if "Match:" in message:
+            targets = re.findall(r"^(\d+)\. ", message, re.MULTILINE)
+            return "Match: {}".format(rng.choice(targets)) if targets and rng.random() < self.yes_rate else "Match: none"
+        if "better, worse, or equal" in message:
+            return rng.choice(["Better", "Worse", "Worse", "Equal"])
+        if "Summary:" in message:
+            return "Summary: " + " ".join(self.sentence(rng) for _ in range(3))
+        match = re.search(r"Use the format:? \"(.+?): (?:message|converted text)\"", message)
+        if match:
+            name = match.group(1)
+            if name == "name":
+                name = rng.choice(names) if names else "Someone"
+            return "{}: {}".format(name, self.sentence(rng))
+        return self.sentence(rng)
+
+    async def complete(self, messages: List[Dict[str, str]], model: str, temperature: float, stop: List[str], **kwargs) -> Completion:
+        self.calls += 1
+        rng = self.get_rng(messages)
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.latency + rng.uniform(-self.jitter, self.jitter)))
+        texts = [self.respond(messages, rng) for _ in range(kwargs.get("n", 1))]
+        for sequence in stop or []:
+            texts = [text.split(sequence)[0] for text in texts]
+        prompt_tokens = sum(len(message["content"]) // 4 + 4 for message in messages)
+        completion_tokens = sum(len(text) // 4 + 1 for text in texts)
+        return Completion(texts, {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens})
@@ -0,0 +1,127 @@
+from typing import Dict, List
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeEndpoint:
+    # a local stand in for the chat completions api that injects latency, rate limits and errors on demand
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.05, error_rate: float = 0.0,
+                 requests_per_minute: float = None, window: float = 1.0):
+        self.latency: float = latency
+        self.error_rate: float = error_rate
+        self.requests_per_minute: float = requests_per_minute
+        self.window: float = window
+        self.forced_errors: List[int] = []
+        self.stats: Dict[str, int] = {"connections": 0, "requests": 0, "served": 0, "rate_limited": 0, "errors": 0}
+        self.allowance: float = (requests_per_minute or 0) * window / 60
+        self.updated: float = time.monotonic()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread: threading.Thread = None
+
+    @property
+    def api_base(self) -> str:
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}/v1".format(host, port)
+
+    def fail_next(self, count: int = 1, status: int = 500) -> None:
+        with self.lock:
+            self.forced_errors.extend([status] * count)
+
+    def start(self) -> str:
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.api_base
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def admit(self) -> int:
+        with self.lock:
+            self.stats["requests"] += 1
+            if self.forced_errors:
+                self.stats["errors"] += 1
+                return self.forced_errors.pop(0)
+            if self.requests_per_minute is not None:
+                # providers enforce per minute limits as a bucket that holds a short burst
+                now = time.monotonic()
+                capacity = self.requests_per_minute * self.window / 60
+                self.allowance = min(capacity, self.allowance + (now - self.updated) * self.requests_per_minute / 60)
+                self.updated = now
+                if self.allowance < 1:
+                    self.stats["rate_limited"] += 1
+                    return 429
+                self.allowance -= 1
+            if random.random() < self.error_rate:
+                self.stats["errors"] += 1
+                return random.choice([500, 503])
+            self.stats["served"] += 1
+            return 200
+
+    def make_handler(self) -> type:
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep alive, so clients that pool their connections reuse them
+            protocol_version = "HTTP/1.1"
+
+            def setup(self) -> None:
+                super().setup()
+                with endpoint.lock:
+                    endpoint.stats["connections"] += 1
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def reply(self, status: int, body: Dict, headers: Dict[str, str] = {}) -> None:
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self) -> None:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                time.sleep(endpoint.latency)
+                status = endpoint.admit()
+                if status == 429:
+                    self.reply(429, {"error": {"message": "Rate limit reached for requests", "type": "requests", "code": "rate_limit_exceeded"}},
+                               {"Retry-After": "{:.2f}".format(endpoint.window)})
+                elif status != 200:
+                    self.reply(status, {"error": {"message": "The server had an error while processing your request.", "type": "server_error"}})
+                else:
+                    prompt_tokens = sum(len(message["content"]) // 4 + 4 for message in request.get("messages", []))
+                    self.reply(200, {
+                        "id": "chatcmpl-fake",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": request.get("model"),
+                        "choices": [
+                            {"index": i, "message": {"role": "assistant", "content": "Fake: reply {}".format(random.randint(0, 10 ** 6))}, "finish_reason": "stop"}
+                            for i in range(request.get("n", 1))
+                        ],
+                        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 5, "total_tokens": prompt_tokens + 5},
+                    })
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rpm", type=float, default=None)
+    args = parser.parse_args()
+    endpoint = FakeEndpoint(port=args.port, latency=args.latency, error_rate=args.error_rate, requests_per_minute=args.rpm)
+    print("serving on {}, point OPENAI_API_BASE at it".format(endpoint.api_base))
+    endpoint.server.serve_forever()
@@ -0,0 +1,123 @@
+from typing import Any, Dict, Tuple
+import json
+import time
+import asyncio
+import argparse
+
+import llm
+from backends import MockBackend
+from server import DialogueServer, SessionManager
+from telemetry import Histogram
+
+
+class Client:
+    # one keep alive connection per simulated player
+    def __init__(self, host: str, port: int):
+        self.host: str = host
+        self.port: int = port
+        self.reader: asyncio.StreamReader = None
+        self.writer: asyncio.StreamWriter = None
+
+    async def request(self, method: str, path: str, body: Dict[str, Any] = None) -> Tuple[int, Dict[str, Any]]:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.writer.write("{} {} HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n\r\n".format(method, path, self.host, len(data)).encode("latin-1") + data)
+        await self.writer.drain()
+        status = int((await self.reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = (await self.reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            if name.lower() == "content-length":
+                length = int(value)
+        return status, json.loads(await self.reader.readexactly(length))
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def play(host: str, port: int, turns: int, latencies: Dict[str, Histogram], failures: Dict[str, int]) -> None:
+    client = Client(host, port)
+
+    async def timed(op: str, method: str, path: str, body: Dict[str, Any] = None) -> Dict[str, Any]:
+        start = time.perf_counter()
+        status, payload = await client.request(method, path, body)
+        latencies.setdefault(op, Histogram()).observe(time.perf_counter() - start)
+        if status != 200:
+            failures[op] = failures.get(op, 0) + 1
+            raise RuntimeError(payload.get("error"))
+        return payload
+
+    try:
+        session = (await timed("load", "POST", "/sessions"))["session"]
+        for _ in range(turns):
+            options = (await timed("options", "GET", "/sessions/{}/options".format(session)))["options"]
+            await timed("pc_turn", "POST", "/sessions/{}/pc_turn".format(session), {"text": options[0]})
+            await timed("npc_turn", "POST", "/sessions/{}/npc_turn".format(session))
+        await timed("close", "DELETE", "/sessions/{}".format(session))
+    except RuntimeError:
+        pass
+    finally:
+        client.close()
+
+
+async def run(args: argparse.Namespace) -> None:
+    settings = dict(max_iterations=args.iterations, num_workers=2)
+    manager = SessionManager(args.scenario, idle_timeout=args.idle_timeout, search_settings=settings)
+    server = DialogueServer(manager, port=0)
+    host, port = await server.start()
+
+    latencies, failures = {}, {}
+    peak_queue = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def player() -> None:
+        async with semaphore:
+            await play(host, port, args.turns, latencies, failures)
+
+    async def sample() -> None:
+        nonlocal peak_queue
+        while True:
+            peak_queue = max(peak_queue, manager.metrics()["queue_depth"] + manager.metrics()["running"])
+            await asyncio.sleep(0.05)
+
+    sampler = asyncio.ensure_future(sample())
+    start = time.perf_counter()
+    await asyncio.gather(*[player() for _ in range(args.sessions)])
+    elapsed = time.perf_counter() - start
+    sampler.cancel()
+    metrics = manager.metrics()
+    await server.stop()
+
+    print("{} sessions x {} turns in {:.1f}s: {:.1f} sessions/s, {:.1f} turns/s, peak in flight {}, {} llm calls".format(
+        metrics["sessions_served"], args.turns, elapsed, metrics["sessions_served"] / elapsed, metrics["turns"] / elapsed,
+        peak_queue, llm.get_backend().calls))
+    for op, histogram in latencies.items():
+        stats = histogram.to_dict()
+        print("  {:<9} n={:<5} mean {:.3f}s p50 {:.3f}s p95 {:.3f}s max {:.3f}s failed {}".format(
+            op, stats["count"], stats["mean"], stats["p50"], stats["p95"], stats["max"], failures.get(op, 0)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--turns", type=int, default=2)
+    parser.add_argument("--iterations", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--rpm", type=float, default=None, help="client side request limit, unlimited by default")
+    parser.add_argument("--idle-timeout", type=float, default=60.0)
+    parser.add_argument("--scenario", default="dialogue.json")
+    args = parser.parse_args()
+
+    llm.set_backend(MockBackend(latency=args.latency, jitter=args.latency / 2))
+    llm.max_concurrent_requests = 256
+    llm.rate_limiter = None
+    if args.rpm is not None:
+        from client import RateLimiter
+        llm.rate_limiter = RateLimiter(requests_per_minute=args.rpm, tokens_per_minute=10 ** 9)
+    asyncio.run(run(args))
@@ -0,0 +1,88 @@
+from typing import List
+import time
+import tracemalloc
+
+from character import Character
+from dialogue import Dialogue, DialogueTurn
+from mcts import MCTSNode
+
+
+def make_dialogue(num_turns: int) -> Dialogue:
+    dialogue = Dialogue()
+    dialogue.pc = Character("Bob", "Yo! What's up? My name is Bob.")
+    dialogue.npcs = [Character("Alice", "Hello, my name is Alice.")]
+    for i in range(num_turns):
+        character = dialogue.characters[i % 2]
+        dialogue.add_turn(DialogueTurn(character, "message number {} from {}".format(i, character.name), dialogue.get_state()))
+    return dialogue
+
+
+def legacy_dialogue_prompt(dialogue: Dialogue) -> str:
+    res = "Dialogue so far:"
+    last_states = {character: "" for character in dialogue.npcs}
+    for turn in dialogue.turns:
+        res += "\n{}: {}".format(turn.character.name, turn.text)
+        state_info = turn.character.get_state_desc()
+        if turn.character in last_states and state_info != last_states[turn.character]:
+            res += " ({})".format(state_info)
+            last_states[turn.character] = state_info
+    return res
+
+
+def build_tree(dialogue: Dialogue, num_nodes: int, shared: bool) -> List[object]:
+    # a breadth first binary tree, either of structurally shared nodes or of legacy full prompt copies
+    characters = dialogue.characters
+    root = MCTSNode(dialogue.get_dialogue_prompt(), [characters[0]], None)
+    nodes, queue = [root], [root]
+    legacy = [root.dialogue]
+    while len(nodes) < num_nodes:
+        parent = queue.pop(0)
+        for i in range(2):
+            character = characters[len(nodes) % 2]
+            child = MCTSNode(None, [], parent, character=character, text="candidate message {}".format(len(nodes)))
+            parent.children.append(child)
+            nodes.append(child)
+            queue.append(child)
+            if not shared:
+                legacy.append(parent.dialogue + "\n" + parent.line if parent.line else parent.dialogue)
+    if shared:
+        # every node is evaluated as in a real search, expanded nodes keep their prompt and leaves build theirs on demand
+        for node in nodes:
+            node.history
+        return nodes
+    return nodes + legacy
+
+
+def measure_memory(dialogue: Dialogue, num_nodes: int, shared: bool) -> float:
+    tracemalloc.start()
+    tree = build_tree(dialogue, num_nodes, shared)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del tree
+    return size / num_nodes
+
+
+def measure_prompt_time(num_turns: int, legacy: bool) -> float:
+    # time to produce the prompt after every new turn, as happens once per turn during a session
+    dialogue = make_dialogue(0)
+    start = time.perf_counter()
+    for i in range(num_turns):
+        character = dialogue.characters[i % 2]
+        dialogue.add_turn(DialogueTurn(character, "message number {} from {}".format(i, character.name), dialogue.get_state()))
+        for _ in range(10):
+            legacy_dialogue_prompt(dialogue) if legacy else dialogue.get_dialogue_prompt()
+    return (time.perf_counter() - start) / num_turns
+
+
+if __name__ == "__main__":
+    num_nodes = 255
+    print("{:>8} {:>16} {:>16} {:>16} {:>16}".format("turns", "legacy B/node", "shared B/node", "legacy ms/turn", "shared ms/turn"))
+    for num_turns in [10, 50, 200, 1000]:
+        dialogue = make_dialogue(num_turns)
+        print("{:>8} {:>16.0f} {:>16.0f} {:>16.3f} {:>16.3f}".format(
+            num_turns,
+            measure_memory(dialogue, num_nodes, shared=False),
+            measure_memory(dialogue, num_nodes, shared=True),
+            measure_prompt_time(num_turns, legacy=True) * 1000,
+            measure_prompt_time(num_turns, legacy=False) * 1000,
+        ))
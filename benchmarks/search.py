@@ -0,0 +1,80 @@
+from typing import Dict, List, Tuple
+import json
+import time
+import asyncio
+import argparse
+import itertools
+
+import llm
+from backends import MockBackend
+from cache import ResponseCache
+from character import Character
+from dialogue import Dialogue
+from mcts import MCTS
+
+
+def setup(scenario: str, seed: int, latency: float) -> Tuple[MockBackend, Dialogue]:
+    # a fresh mock backend and cache per run, the rate limiter would only add sleeps to an offline run
+    backend = MockBackend(seed=seed, latency=latency)
+    llm.set_backend(backend)
+    llm.response_cache = ResponseCache()
+    llm.rate_limiter = None
+    dialogue = Dialogue()
+    dialogue.load(scenario)
+    return backend, dialogue
+
+
+async def measure_search(scenario: str, is_pc: bool, seed: int, latency: float, **settings) -> Tuple[MCTS, List[Tuple[Character, str]], Dict[str, float]]:
+    backend, dialogue = setup(scenario, seed, latency)
+    mcts = MCTS(dialogue, is_pc=is_pc, **settings)
+    start = time.perf_counter()
+    ranking = await mcts.search()
+    return mcts, ranking, dict(llm_calls=backend.calls, wall_time=time.perf_counter() - start, **mcts.get_tree_stats())
+
+
+async def run_search(scenario: str, is_pc: bool, seed: int, latency: float, **settings) -> Dict[str, float]:
+    _, _, stats = await measure_search(scenario, is_pc, seed, latency, **settings)
+    return dict(settings, is_pc=is_pc, seed=seed, **stats)
+
+
+async def run_turn(scenario: str, seed: int, latency: float) -> Dict[str, float]:
+    backend, dialogue = setup(scenario, seed, latency)
+    start = time.perf_counter()
+    options = await dialogue.get_pc_options()
+    await dialogue.add_pc_turn(options[0])
+    await dialogue.take_npc_turn()
+    return dict(llm_calls=backend.calls, wall_time=time.perf_counter() - start)
+
+
+def summarize(results: List[Dict[str, float]], keys: List[str] = ("llm_calls", "wall_time", "nodes", "depth")) -> Dict[str, float]:
+    # averages the keys every result reports, a full turn spans several searches and has no single tree to describe
+    return {key: sum(result[key] for result in results) / len(results) for key in keys if all(key in result for result in results)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenario", default="dialogue.json")
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated seconds per llm call")
+    parser.add_argument("--seeds", type=int, default=3)
+    parser.add_argument("--max-iterations", type=int, nargs="+", default=[5, 10, 20])
+    parser.add_argument("--num-expand", type=int, nargs="+", default=[1, 2, 3])
+    parser.add_argument("--rollout-depth", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--output", help="write one json line per configuration for regression tracking")
+    args = parser.parse_args()
+
+    rows = []
+    print("{:>5} {:>6} {:>6} {:>7} {:>10} {:>10} {:>8} {:>6}".format("pc", "iters", "expand", "depth", "llm calls", "wall s", "nodes", "height"))
+    for is_pc, max_iterations, num_expand, rollout_depth in itertools.product([True, False], args.max_iterations, args.num_expand, args.rollout_depth):
+        settings = dict(max_iterations=max_iterations, num_expand=num_expand, rollout_depth=rollout_depth)
+        results = [asyncio.run(run_search(args.scenario, is_pc, seed, args.latency, **settings)) for seed in range(args.seeds)]
+        row = dict(settings, is_pc=is_pc, **summarize(results))
+        rows.append(row)
+        print("{:>5} {:>6} {:>6} {:>7} {:>10.1f} {:>10.2f} {:>8.1f} {:>6.1f}".format(
+            str(is_pc), max_iterations, num_expand, rollout_depth, row["llm_calls"], row["wall_time"], row["nodes"], row["depth"]))
+    turn = summarize([asyncio.run(run_turn(args.scenario, seed, args.latency)) for seed in range(args.seeds)])
+    rows.append(dict(turn, full_turn=True))
+    print("full turn with default settings: {:.1f} llm calls, {:.2f} s".format(turn["llm_calls"], turn["wall_time"]))
+    if args.output:
+        with open(args.output, "w") as file:
+            for row in rows:
+                file.write(json.dumps(row) + "\n")
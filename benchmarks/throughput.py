@@ -0,0 +1,51 @@
+import time
+import asyncio
+import argparse
+
+import llm
+from backends import OpenAIBackend
+from client import CircuitBreaker, RateLimiter
+from benchmarks.fake_endpoint import FakeEndpoint
+
+
+async def drive(num_requests: int, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = 0
+
+    async def call(i: int) -> None:
+        nonlocal failures
+        async with semaphore:
+            try:
+                await llm.get_response_async([dict(role="user", content="request {}".format(i))], cache=False)
+            except Exception:
+                failures += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[call(i) for i in range(num_requests)])
+    return time.perf_counter() - start, failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rpm", type=float, default=1200)
+    parser.add_argument("--error-rate", type=float, default=0.05)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+
+    llm.max_concurrent_requests = args.concurrency
+    for limited in [False, True]:
+        endpoint = FakeEndpoint(requests_per_minute=args.rpm, error_rate=args.error_rate)
+        llm.set_backend(OpenAIBackend(api_key="unused", api_base=endpoint.start()))
+        llm.rate_limiter = RateLimiter(requests_per_minute=args.rpm, tokens_per_minute=10 ** 9, burst=1.0) if limited else None
+        llm.circuit_breaker = CircuitBreaker(failure_threshold=10 ** 6)
+        elapsed, failures = llm.run(drive(args.requests, args.concurrency))
+        endpoint.stop()
+        print("client limiter {:>3}: {:.0f} requests/min (limit {:.0f}), {} rejected with 429, {} server errors, {} failed calls".format(
+            "on" if limited else "off",
+            (args.requests - failures) / elapsed * 60,
+            args.rpm,
+            endpoint.stats["rate_limited"],
+            endpoint.stats["errors"],
+            failures,
+        ))
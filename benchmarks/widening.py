@@ -0,0 +1,60 @@
+from typing import Any, Dict
+import json
+import asyncio
+import argparse
+import itertools
+
+from benchmarks.search import measure_search, summarize
+
+
+policies: Dict[str, Dict[str, Any]] = {
+    "fixed": dict(),
+    "widening": dict(progressive_widening=True),
+    "widening+pruning": dict(progressive_widening=True, prune_dominated=True),
+}
+
+
+async def run_search(scenario: str, is_pc: bool, seed: int, latency: float, **settings) -> Dict[str, float]:
+    mcts, ranking, stats = await measure_search(scenario, is_pc, seed, latency, **settings)
+    # quality is the value of the line the search settles on, a talking point hit counts as a perfect line
+    best = next((child for child in mcts.root.children if (child.character, child.text) == ranking[0]), None)
+    value = 1.0 if mcts.stop_reason == "talking_point" else (best.reward / best.visits if best is not None and best.visits else 0.0)
+    return dict(
+        stats,
+        value=value,
+        found=float(mcts.stop_reason == "talking_point"),
+        widened=mcts.policy_stats["widened"],
+        pruned=mcts.policy_stats["pruned"],
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenario", default="dialogue.json")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated seconds per llm call")
+    parser.add_argument("--seeds", type=int, default=5)
+    parser.add_argument("--max-iterations", type=int, nargs="+", default=[10, 20])
+    parser.add_argument("--exploration", type=float, default=2.0)
+    parser.add_argument("--output", help="write one json line per configuration for regression tracking")
+    args = parser.parse_args()
+
+    rows = []
+    print("{:>5} {:>6} {:>6} {:>17} {:>10} {:>7} {:>6} {:>7} {:>6} {:>8} {:>7}".format(
+        "pc", "iters", "batch", "policy", "llm calls", "saved", "value", "found", "nodes", "widened", "pruned"))
+    for is_pc, max_iterations, batch_expand in itertools.product([True, False], args.max_iterations, [False, True]):
+        baseline = None
+        for name, policy in policies.items():
+            settings = dict(policy, max_iterations=max_iterations, batch_expand=batch_expand, exploration=args.exploration)
+            row = summarize([asyncio.run(run_search(args.scenario, is_pc, seed, args.latency, **settings)) for seed in range(args.seeds)],
+                            ["llm_calls", "wall_time", "value", "found", "nodes", "depth", "widened", "pruned"])
+            baseline = baseline or row
+            row = dict(row, is_pc=is_pc, max_iterations=max_iterations, batch_expand=batch_expand, policy=name,
+                       calls_saved=baseline["llm_calls"] - row["llm_calls"])
+            rows.append(row)
+            print("{:>5} {:>6} {:>6} {:>17} {:>10.1f} {:>7.1f} {:>6.2f} {:>7.2f} {:>6.1f} {:>8.1f} {:>7.1f}".format(
+                str(is_pc), max_iterations, str(batch_expand), name, row["llm_calls"], row["calls_saved"], row["value"], row["found"],
+                row["nodes"], row["widened"], row["pruned"]))
+    if args.output:
+        with open(args.output, "w") as file:
+            for row in rows:
+                file.write(json.dumps(row) + "\n")
@@ -0,0 +1,77 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from collections import OrderedDict
+import hashlib
+import json
+import sqlite3
+
+
+class ResponseCache:
+    def __init__(self, max_size: int = 4096, path: Optional[str] = None, sites: Iterable[str] = ("judge", "classify")):
+        self.max_size: int = max_size
+        self.path: Optional[str] = path
+        self.sites: set = set(sites)
+        self.entries: OrderedDict[str, Tuple[str, float]] = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+        self.saved_seconds: float = 0.0
+        self.db: Optional[sqlite3.Connection] = None
+        if path:
+            self.db = sqlite3.connect(path)
+            self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, latency REAL)")
+            self.db.commit()
+
+    @staticmethod
+    def make_key(model: str, messages: List[Dict[str, str]], temperature: float, stop: Any, kwargs: Dict[str, Any]) -> str:
+        data = json.dumps([model, messages, temperature, stop, kwargs], sort_keys=True, default=str)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def allowed(self, site: Optional[str], cache: Optional[bool] = None) -> bool:
+        # an explicit request from the caller wins over the per-site rules
+        if cache is not None:
+            return cache
+        return site in self.sites
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        elif self.db is not None:
+            row = self.db.execute("SELECT response, latency FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                entry = (row[0], row[1])
+                self._remember(key, entry)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.saved_seconds += entry[1]
+        return entry[0]
+
+    def put(self, key: str, response: str, latency: float = 0.0) -> None:
+        self._remember(key, (response, latency))
+        if self.db is not None:
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, response, latency))
+            self.db.commit()
+
+    def _remember(self, key: str, entry: Tuple[str, float]) -> None:
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        if self.db is not None:
+            self.db.execute("DELETE FROM responses")
+            self.db.commit()
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "saved_seconds": self.saved_seconds,
+            "size": len(self.entries),
+        }
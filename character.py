@@ -1,10 +1,12 @@
 from __future__ import annotations
-from typing import Dict, List, Union, TYPE_CHECKING
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union, TYPE_CHECKING
 if TYPE_CHECKING:
     from dialogue import Dialogue
+import re
 import enum
+import asyncio
 
-from llm import get_response
+from llm import get_response_async
 
 
 class myEnum(enum.Enum):
@@ -37,12 +39,57 @@ class Relation(myEnum):
 
 
 class CharacterState:
-    def __init__(self, attitude: Union[int, str, Attitude] = Attitude.CALM, relations: Dict[Character, Union[int, str, Relation]] = dict()):
-        self.attitude: Attitude = Attitude.get_enum(attitude) if attitude is not None else None
-        self.relations: Dict[Character, Relation] = {
-            char: Relation.get_enum(aff)
-            for char, aff in relations.items() if aff is not None
-        }
+    # immutable, so turns and forks share unchanged states instead of copying them
+    __slots__ = ("attitude", "relations")
+
+    def __init__(self, attitude: Union[int, str, Attitude] = Attitude.CALM,
+                 relations: Union[Dict[Character, Union[int, str, Relation]], Iterable[Tuple[Character, Union[int, str, Relation]]]] = ()):
+        items = relations.items() if isinstance(relations, dict) else relations
+        object.__setattr__(self, "attitude", Attitude.get_enum(attitude) if attitude is not None else None)
+        object.__setattr__(self, "relations", tuple((char, Relation.get_enum(aff)) for char, aff in items if aff is not None))
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("CharacterState is immutable, use replace or merge")
+
+    # copies can share the state itself, and pickling rebuilds it through __init__ rather than setattr
+    def __copy__(self) -> CharacterState:
+        return self
+
+    def __deepcopy__(self, memo: Dict[int, Any]) -> CharacterState:
+        return self
+
+    def __reduce__(self) -> Tuple[type, Tuple[Any, ...]]:
+        return (CharacterState, (self.attitude, self.relations))
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, CharacterState) and self.attitude == other.attitude and dict(self.relations) == dict(other.relations)
+
+    def __hash__(self) -> int:
+        return hash((self.attitude, frozenset(self.relations)))
+
+    def __repr__(self) -> str:
+        return "CharacterState({}, {{{}}})".format(
+            self.attitude and self.attitude.name, ", ".join("{}: {}".format(char.name, relation.name) for char, relation in self.relations))
+
+    def get_relation(self, character: Character, default: Relation = None) -> Optional[Relation]:
+        for char, relation in self.relations:
+            if char == character:
+                return relation
+        return default
+
+    def replace(self, attitude: Union[int, str, Attitude] = None, relations: Dict[Character, Union[int, str, Relation]] = None) -> CharacterState:
+        # a new state with the given fields overridden, or this one if nothing changes
+        attitude = Attitude.get_enum(attitude) if attitude is not None else self.attitude
+        merged = dict(self.relations)
+        for char, aff in (relations or {}).items():
+            if aff is not None:
+                merged[char] = Relation.get_enum(aff)
+        if attitude == self.attitude and merged == dict(self.relations):
+            return self
+        return CharacterState(attitude, merged)
+
+    def merge(self, state: CharacterState) -> CharacterState:
+        return self.replace(state.attitude, dict(state.relations))
 
 
 class Character:
@@ -62,42 +109,37 @@ class Character:
         return self.state.attitude
 
     def set_attitude(self, value: Union[int, str, Attitude]) -> None:
-        if value is not None:
-            self.state.attitude = Attitude.get_enum(value)
+        self.state = self.state.replace(attitude=value)
 
     @property
     def relations(self) -> Dict[Character, Relation]:
-        return self.state.relations
+        return dict(self.state.relations)
     
     def get_relation(self, character: Character) -> Relation:
-        return self.relations.get(character, Relation.NEUTRAL)
+        return self.state.get_relation(character, Relation.NEUTRAL)
 
     def set_relation(self, character: Character, value: Union[int, str, Relation]) -> None:
-        if value is not None:
-            self.state.relations[character] = Relation.get_enum(value)
+        self.state = self.state.replace(relations={character: value})
     
     def update_state(self, state: CharacterState) -> None:
-        if state.attitude is not None:
-            self.state.attitude = state.attitude
-        if state.relations is not None:
-            for character, relation in state.relations.items():
-                self.set_relation(character, relation)
+        self.state = self.state.merge(state)
 
-    def get_state_desc(self, relevant: List[Character] = None) -> str:
+    def get_state_desc(self, relevant: List[Character] = None, state: CharacterState = None) -> str:
+        state = state or self.state
         return "{} is feeling {} and feels {}".format(
             self.name,
-            self.attitude.name.lower(),
+            state.attitude.name.lower(),
             ", ".join(
                 "{} towards {}".format(
                     relation.name.lower(),
                     character.name
                 )
-                for character, relation in self.relations.items()
+                for character, relation in state.relations
                 if relevant is None or character in relevant
             )
         )
     
-    def translate(self, dialogue: Dialogue, text: str) -> str:
+    async def translate(self, dialogue: Dialogue, text: str) -> str:
         system_prompt = dialogue.get_system_prompt()
         system_prompt += "\n\n" + dialogue.get_character_prompt()
         message = dialogue.get_talking_point_prompt()
@@ -111,54 +153,91 @@ class Character:
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": message}
         ]
-        return get_response(messages).split(self.name+":")[-1].strip()
+        return (await get_response_async(messages, site="translate")).split(self.name+":")[-1].strip()
 
-    def adjust_state(self, dialogue: Dialogue, character: Character) -> CharacterState:
+    def get_state_prompt(self, dialogue: Dialogue) -> List[Dict[str, str]]:
         system_prompt = dialogue.get_system_prompt()
         system_prompt += "\n\n" + dialogue.get_character_prompt()
         message = dialogue.get_talking_point_prompt()
         message += "\n\n" + dialogue.get_dialogue_prompt()
-
-        # ask for new attitude
-        message += "\n\nWhich of the following attitudes best describes how {}'s words have affected {}?".format(character.name, self.name)
-        message += "\n\nAttitudes: {}".format(", ".join(att.name.lower() for att in Attitude))
-        message += "\n\nUse the format \"New Attitude: attitude from list\"".format(self.name)
-
-        messages = [
+        return [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": message}
         ]
-        res = get_response(messages)
-
-        # update state
-        success = True
-        if res.startswith("New Attitude:"):
-            try:
-                self.set_attitude(res.split("New Attitude:")[1].lower().strip())
-            except:
-                success = False
-        else:
-            success = False
-        if not success:
-            res = "New Attitude: none"
-        messages.append({
-            "role": "assistant",
-            "content": res
-        })
-        
-        # ask for new relations
-        message = "Which of the following relationships best describe how {} now feels about {}?".format(self.name, character.name)
+
+    async def adjust_state(self, dialogue: Dialogue, character: Character) -> CharacterState:
+        # one call for both fields, only the fields that fail to parse are asked for again on their own
+        messages = self.get_state_prompt(dialogue)
+        message = "\n\nWhich of the following attitudes best describes how {}'s words have affected {},".format(character.name, self.name)
+        message += " and which of the following relationships best describes how {} now feels about {}?".format(self.name, character.name)
+        message += "\n\nAttitudes: {}".format(", ".join(att.name.lower() for att in Attitude))
+        message += "\nRelationships: {}".format(", ".join(aff.name.lower() for aff in Relation))
+        message += "\n\nUse the format:\nNew Attitude: attitude from list\nNew Relationship: relationship from list"
+        messages[-1]["content"] += message
+        res = await get_response_async(messages, stop=None, site="classify")
+        return await self.complete_state(dialogue, character, parse_attitude(res), parse_relation(res))
+
+    async def complete_state(self, dialogue: Dialogue, character: Character, attitude: Attitude = None, relation: Relation = None) -> CharacterState:
+        attitude, relation = await asyncio.gather(
+            self.ask_attitude(dialogue, character) if attitude is None else asyncio.sleep(0, attitude),
+            self.ask_relation(dialogue, character) if relation is None else asyncio.sleep(0, relation),
+        )
+        return CharacterState(attitude, {character: relation})
+
+    async def ask_attitude(self, dialogue: Dialogue, character: Character) -> Attitude:
+        messages = self.get_state_prompt(dialogue)
+        message = "\n\nWhich of the following attitudes best describes how {}'s words have affected {}?".format(character.name, self.name)
+        message += "\n\nAttitudes: {}".format(", ".join(att.name.lower() for att in Attitude))
+        message += "\n\nUse the format \"New Attitude: attitude from list\""
+        messages[-1]["content"] += message
+        return parse_attitude(await get_response_async(messages, site="classify"))
+
+    async def ask_relation(self, dialogue: Dialogue, character: Character) -> Relation:
+        messages = self.get_state_prompt(dialogue)
+        message = "\n\nWhich of the following relationships best describe how {} now feels about {}?".format(self.name, character.name)
         message += "\n\nRelationships: {}".format(", ".join(aff.name.lower() for aff in Relation))
-        message += "\n\nUse the format \"New Relationship: relationship from list\"".format(self.name)
-        messages.append({
-            "role": "user",
-            "content": message
-        })
-        res = get_response(messages)
-
-        # update state
-        try:
-            self.set_attitude(res.split("New Relationship:")[1].lower().strip())
-        except:
-            pass
-        return self.state
+        message += "\n\nUse the format \"New Relationship: relationship from list\""
+        messages[-1]["content"] += message
+        return parse_relation(await get_response_async(messages, site="classify"))
+
+
+def parse_attitude(res: str) -> Optional[Attitude]:
+    match = re.search(r"New Attitude:\s*(\w+)", res, re.IGNORECASE)
+    try:
+        return Attitude.get_enum(match.group(1).upper()) if match else None
+    except IndexError:
+        return None
+
+
+def parse_relation(res: str) -> Optional[Relation]:
+    match = re.search(r"New Relationship:\s*(\w+)", res, re.IGNORECASE)
+    try:
+        return Relation.get_enum(match.group(1).upper()) if match else None
+    except IndexError:
+        return None
+
+
+async def adjust_states(dialogue: Dialogue, characters: List[Character], character: Character) -> List[CharacterState]:
+    # a single call covering every character, anyone missing from the answer falls back to adjust_state
+    if len(characters) == 1:
+        return [await characters[0].adjust_state(dialogue, character)]
+    messages = characters[0].get_state_prompt(dialogue)
+    message = "\n\nFor each of {}, which of the following attitudes best describes how {}'s words have affected them,".format(
+        ", ".join(c.name for c in characters), character.name)
+    message += " and which of the following relationships best describes how they now feel about {}?".format(character.name)
+    message += "\n\nAttitudes: {}".format(", ".join(att.name.lower() for att in Attitude))
+    message += "\nRelationships: {}".format(", ".join(aff.name.lower() for aff in Relation))
+    message += "\n\nUse the format, one line per character:"
+    for c in characters:
+        message += "\n{}: New Attitude: attitude from list, New Relationship: relationship from list".format(c.name)
+    messages[-1]["content"] += message
+    res = await get_response_async(messages, stop=None, site="classify")
+
+    lines = {}
+    for line in res.splitlines():
+        name, _, rest = line.partition(":")
+        lines[name.strip().strip("*").lower()] = rest
+    return await asyncio.gather(*[
+        c.complete_state(dialogue, character, parse_attitude(lines.get(c.name.lower(), "")), parse_relation(lines.get(c.name.lower(), "")))
+        for c in characters
+    ])
@@ -0,0 +1,159 @@
+from typing import Optional
+import time
+import random
+import asyncio
+import openai
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class RetryPolicy:
+    def __init__(self, max_tries: int = 8, base_delay: float = 0.5, max_delay: float = 30.0, rate_limit_delay: float = 2.0):
+        self.max_tries: int = max_tries
+        self.base_delay: float = base_delay
+        self.max_delay: float = max_delay
+        self.rate_limit_delay: float = rate_limit_delay
+
+    def classify(self, error: Exception) -> str:
+        if isinstance(error, openai.error.RateLimitError):
+            return "rate_limit"
+        if isinstance(error, (openai.error.InvalidRequestError, openai.error.AuthenticationError, openai.error.PermissionError)):
+            return "fatal"
+        if isinstance(error, (openai.error.OpenAIError, asyncio.TimeoutError, ConnectionError)):
+            return "transient"
+        return "fatal"
+
+    def delay(self, attempt: int, error: Exception) -> float:
+        # full jitter keeps concurrent callers from retrying in lockstep
+        base = self.rate_limit_delay if self.classify(error) == "rate_limit" else self.base_delay
+        delay = random.uniform(0, min(self.max_delay, base * 2 ** attempt))
+        headers = getattr(error, "headers", None) or {}
+        try:
+            retry_after = float(headers.get("retry-after", 0))
+        except (TypeError, ValueError):
+            retry_after = 0
+        return max(delay, retry_after)
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float, burst: float = 10.0):
+        self.rate: float = per_minute / 60
+        self.capacity: float = max(self.rate * burst, 1)
+        self.tokens: float = self.capacity
+        self.updated: float = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1) -> None:
+        # reserve right away and sleep off any debt, which keeps waiters in arrival order without a lock
+        self.refill()
+        self.tokens -= min(amount, self.capacity)
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+    def refund(self, amount: float) -> None:
+        self.refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute: float = 3500, tokens_per_minute: float = 90000, burst: float = 10.0):
+        self.requests: TokenBucket = TokenBucket(requests_per_minute, burst)
+        self.tokens: TokenBucket = TokenBucket(tokens_per_minute, burst)
+
+    async def acquire(self, tokens: int) -> None:
+        await self.requests.acquire(1)
+        await self.tokens.acquire(tokens)
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold: int = failure_threshold
+        self.reset_timeout: float = reset_timeout
+        self.failures: int = 0
+        self.opened_at: Optional[float] = None
+        self.trial: bool = False
+        self.probe: Optional[asyncio.Future] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "open" if time.monotonic() - self.opened_at < self.reset_timeout else "half-open"
+
+    def check(self) -> bool:
+        # returns whether the caller is the half-open trial, which must then record an outcome or abandon
+        state = self.state
+        if state == "open" or (state == "half-open" and self.trial):
+            raise CircuitOpenError("LLM endpoint is failing, requests are paused for up to {:.0f}s".format(self.reset_timeout))
+        if state == "half-open":
+            # let a single trial request through to probe the endpoint
+            self.trial = True
+            self.probe = asyncio.get_running_loop().create_future()
+            return True
+        return False
+
+    async def acquire(self) -> bool:
+        # callers arriving while the trial is in flight wait for its outcome, then go ahead or fail with the reopened circuit
+        while self.state == "half-open" and self.trial and self.probe is not None:
+            if self.probe.get_loop() is not asyncio.get_running_loop():
+                # the trial belonged to an event loop that has since finished
+                self.settle()
+                break
+            await asyncio.shield(self.probe)
+        return self.check()
+
+    def settle(self) -> None:
+        self.trial = False
+        if self.probe is not None and not self.probe.done() and not self.probe.get_loop().is_closed():
+            self.probe.set_result(None)
+        self.probe = None
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.settle()
+
+    def abandon(self) -> None:
+        # a cancelled trial says nothing about the endpoint, the next waiter becomes the trial
+        self.settle()
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.trial or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self.settle()
+
+
+class BudgetExceededError(RuntimeError):
+    pass
+
+
+class CallBudget:
+    def __init__(self, max_calls: int = None, max_tokens: int = None):
+        self.max_calls: Optional[int] = max_calls
+        self.max_tokens: Optional[int] = max_tokens
+        self.calls: int = 0
+        self.tokens: int = 0
+        self.enforce: bool = True
+
+    def reserve(self, tokens: int) -> None:
+        # calls made while enforce is off are still charged, so an overdraw shows in the totals
+        if not self.enforce:
+            self.calls += 1
+            self.tokens += tokens
+            return
+        if self.max_calls is not None and self.calls >= self.max_calls:
+            raise BudgetExceededError("llm call budget of {} calls is used up".format(self.max_calls))
+        if self.max_tokens is not None and self.tokens + tokens > self.max_tokens:
+            raise BudgetExceededError("llm token budget of {} tokens is used up".format(self.max_tokens))
+        self.calls += 1
+        self.tokens += tokens
+
+    def settle(self, reserved: int, used: int) -> None:
+        self.tokens += used - reserved
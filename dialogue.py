@@ -1,10 +1,16 @@
 from __future__ import annotations
-from typing import List, Dict
+from typing import Any, List, Dict, Optional, TYPE_CHECKING
+if TYPE_CHECKING:
+    from graph import DialogueGraph
 import json
-from copy import deepcopy
+import hashlib
+import asyncio
+from copy import copy
 
-from character import Character, CharacterState
+from character import Character, CharacterState, adjust_states
+from llm import count_tokens, get_response_async
 from mcts import MCTS
+from similarity import TalkingPointFilter
 
 
 class DialogueTurn:
@@ -34,6 +40,27 @@ class Dialogue:
         self.talking_points: List[TalkingPoint] = []
         self.last_options: List[str] = None
         self.max_player_options = 2
+        self.mcts: MCTS = None
+        self.search_settings: Dict[str, Any] = {}
+        self.history: List[str] = []
+        self.last_state_descs: Dict[Character, str] = {}
+        self.dialogue_prompt: str = None
+        self.prefilter: TalkingPointFilter = None
+        self.max_history_tokens: int = 3000
+        self.keep_turns: int = 8
+        self.summary: str = ""
+        self.summarized_turns: int = 0
+        self.speculations: Dict[str, asyncio.Task] = {}
+        self.speculated_npc_turn: bool = False
+        self.batch_state_update: bool = True
+        self.snapshot_path: str = None
+        self.snapshot_turns: int = 0
+        self.snapshot_tail: bytes = b""
+        self.snapshot_stale: int = 0
+        self.fingerprint: str = None
+        self.graph: DialogueGraph = None
+        self.graph_position: Optional[int] = None
+        self.graph_edge: Dict[str, Any] = None
     
     @property
     def characters(self) -> List[Character]:
@@ -44,8 +71,11 @@ class Dialogue:
     
     def load(self, load_path: str) -> None:
         with open(load_path, "r") as file:
-            data = json.load(file)
-        
+            self.load_data(json.load(file))
+
+    def load_data(self, data: Dict[str, Any]) -> None:
+        self.fingerprint = hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
         # load player character
         self.pc = Character(data["pc"]["name"], data["pc"]["bio"])
 
@@ -69,19 +99,56 @@ class Dialogue:
                 for point in talkingpoint["points"]
             }
             self.talking_points.append(TalkingPoint(character, order, desc, texts))
+        self.prefilter = TalkingPointFilter([text for tp in self.talking_points for text in tp.targets])
 
         # load initial text
         for turn in data["turns"]:
             character = self.get_character(turn["character"])
             text = turn["text"]
-            self.turns.append(DialogueTurn(character, text, self.get_state()))
+            self.add_turn(DialogueTurn(character, text, self.get_state()))
 
     def get_state(self) -> Dict[Character, CharacterState]:
+        # states are immutable, so a shallow copy shares every unchanged npc with the previous turn
         if not self.turns or not self.turns[-1].state:
-            return deepcopy({npc: npc.state for npc in self.npcs})
-        return deepcopy(self.turns[-1].state)
+            return {npc: npc.state for npc in self.npcs}
+        return dict(self.turns[-1].state)
     
+    def add_turn(self, turn: DialogueTurn) -> DialogueTurn:
+        # format each turn once, only annotating npc lines whose state description changed
+        self.turns.append(turn)
+        line = "{}: {}".format(turn.character.name, turn.text)
+        if turn.character in self.npcs:
+            state_info = turn.character.get_state_desc(state=turn.state.get(turn.character))
+            if state_info != self.last_state_descs.get(turn.character, ""):
+                line += " ({})".format(state_info)
+                self.last_state_descs[turn.character] = state_info
+        self.history.append(line)
+        self.dialogue_prompt = None
+        return turn
+
+    async def compact_history(self) -> None:
+        # once the verbatim history outgrows its budget, fold all but the latest turns into the running summary
+        recent = self.history[self.summarized_turns:]
+        if len(recent) <= self.keep_turns or count_tokens("\n".join(recent)) <= self.max_history_tokens:
+            return
+        older = recent[:-self.keep_turns]
+        message = ""
+        if self.summary:
+            message += "Summary of the earlier dialogue:\n" + self.summary + "\n\n"
+        message += "Dialogue:\n" + "\n".join(older)
+        message += "\n\nSummarize the dialogue above in a single paragraph, keeping what each character said, wants and feels."
+        message += "\n\nUse the format \"Summary: summary\""
+        res = await get_response_async([
+            dict(role="system", content=self.get_system_prompt()),
+            dict(role="user", content=message)
+        ], stop=None, site="summarize")
+        self.summary = res.split("Summary:")[-1].strip()
+        self.summarized_turns += len(older)
+        self.dialogue_prompt = None
+
     def get_next_talking_points(self) -> List[TalkingPoint]:
+        if not self.talking_points:
+            return []
         min_order = min([tp.order for tp in self.talking_points])
         return [tp for tp in self.talking_points if tp.order == min_order]
     
@@ -91,38 +158,135 @@ class Dialogue:
                 return tp
         return None
 
-    def add_pc_turn(self, text: str) -> None:
+    def fork(self) -> Dialogue:
+        # an independent copy for speculative turns, including its own copy of the search tree
+        fork = copy(self)
+        fork.pc = copy(self.pc)
+        fork.npcs = [copy(npc) for npc in self.npcs]
+        fork.turns = list(self.turns)
+        fork.talking_points = list(self.talking_points)
+        fork.history = list(self.history)
+        fork.last_state_descs = dict(self.last_state_descs)
+        fork.mcts = self.mcts.fork() if self.mcts is not None else None
+        fork.speculations = {}
+        return fork
+
+    def use_graph(self, graph: DialogueGraph) -> None:
+        # call right after loading, the first position of a graph is the scenario as authored
+        if graph.fingerprint != self.fingerprint:
+            raise ValueError("{} was compiled from a different scenario".format(graph.path))
+        self.graph = graph
+        self.graph_position = 0
+
+    def speculate(self) -> None:
+        # play every offered option and the npc reply in the background while the player is still choosing,
+        # calling it again for the same options keeps the speculations already running
+        options = self.last_options or []
+        for option in [option for option in self.speculations if option not in options]:
+            self.speculations.pop(option).cancel()
+        for option in options:
+            if option in self.speculations:
+                continue
+            if self.graph_position is not None and option in self.graph.get(self.graph_position)["edges"]:
+                continue
+            self.speculations[option] = asyncio.ensure_future(self.speculate_option(option))
+
+    async def speculate_option(self, text: str) -> Dialogue:
+        fork = self.fork()
+        await fork.add_pc_turn(text)
+        await fork.take_npc_turn()
+        return fork
+
+    def cancel_speculations(self) -> None:
+        for task in self.speculations.values():
+            task.cancel()
+        self.speculations = {}
+
+    async def commit_speculation(self, text: str) -> bool:
+        task = self.speculations.pop(text, None)
+        self.cancel_speculations()
+        if task is None:
+            return False
+        try:
+            fork = await task
+        except Exception as e:
+            print("speculation for {!r} failed, running the turn live: {}".format(text, e))
+            return False
+        self.__dict__.update(fork.__dict__)
+        self.speculated_npc_turn = True
+        return True
+
+    async def add_pc_turn(self, text: str) -> None:
+        if await self.commit_speculation(text):
+            return self.turns[-2]
+        edge = self.graph.edge(self.graph_position, text) if self.graph_position is not None else None
+        if edge is not None:
+            # a precompiled exchange, the npc reply is applied by take_npc_turn
+            self.graph_edge = edge
+            self.mcts = None
+            self.last_options = None
+            return self.graph.apply(self, edge["pc"])
+        self.graph_position = None
         if self.last_options and text not in self.last_options:
-            text = self.pc.translate(self, text)
-        self.turns.append(DialogueTurn(self.pc, text, self.get_state()))
-        for npc in self.npcs:
-            npc.update_state(npc.adjust_state(self, self.pc))
-            self.turns[-1].state[npc] = deepcopy(npc.state)
+            text = await self.pc.translate(self, text)
+        self.add_turn(DialogueTurn(self.pc, text, self.get_state()))
+        if self.batch_state_update:
+            states = await adjust_states(self, self.npcs, self.pc)
+        else:
+            states = await asyncio.gather(*[npc.adjust_state(self, self.pc) for npc in self.npcs])
+        for npc, state in zip(self.npcs, states):
+            npc.update_state(state)
+            self.turns[-1].state[npc] = npc.state
+        await self.compact_history()
+        if self.mcts is not None and not self.mcts.reroot(self, self.pc, text):
+            self.mcts = None
         self.last_options = None
         return self.turns[-1]
 
-    def get_pc_options(self) -> List[str]:
+    async def get_pc_options(self) -> List[str]:
         if self.last_options:
             return self.last_options
-        mcts = MCTS(self, is_pc=True)
-        self.last_options = [text for (_ , text) in mcts.search()[:self.max_player_options]]
+        if self.graph_position is not None:
+            self.last_options = list(self.graph.options(self.graph_position))
+            return self.last_options
+        if self.mcts is None or not self.mcts.is_pc:
+            self.mcts = MCTS(self, is_pc=True, **self.search_settings)
+        self.last_options = [text for (_ , text) in (await self.mcts.search())[:self.max_player_options]]
         return self.last_options
 
-    def take_npc_turn(self) -> DialogueTurn:
-        mcts = MCTS(self)
-        character, text = mcts.search()[0]
+    async def take_npc_turn(self) -> DialogueTurn:
+        if self.speculated_npc_turn:
+            self.speculated_npc_turn = False
+            return self.turns[-1]
+        if self.graph_edge is not None:
+            edge, self.graph_edge = self.graph_edge, None
+            turn = self.graph.apply(self, edge["npc"])
+            remaining = set(edge["talking_points"])
+            self.talking_points = [tp for tp in self.talking_points if tp.targets[0] in remaining]
+            self.graph_position = edge["next"]
+            return turn
+        if self.mcts is None or self.mcts.is_pc:
+            self.mcts = MCTS(self, **self.search_settings)
+        ranking = await self.mcts.search()
+        if not ranking:
+            raise RuntimeError("the npc search found no line to say, stopped by {}".format(self.mcts.stop_reason))
+        character, text = ranking[0]
+        character = self.get_character(character.name)
         tp = self.get_talking_point(text)
         if tp:
             self.talking_points = [tp for tp in self.talking_points if text not in tp.targets]
             character.update_state(tp.text_effects[text])
-            text = character.translate(self, text)
+            text = await character.translate(self, text)
             state = self.get_state()
-            state[character] = deepcopy(character.state)
+            state[character] = character.state
         else:
-            character.update_state(character.adjust_state(self, self.pc))
+            character.update_state(await character.adjust_state(self, self.pc))
             state = self.get_state()
-            state[character] = deepcopy(character.state)
-        self.turns.append(DialogueTurn(character, text, state))
+            state[character] = character.state
+        self.add_turn(DialogueTurn(character, text, state))
+        await self.compact_history()
+        if self.mcts is not None and (tp or not self.mcts.reroot(self, character, text)):
+            self.mcts = None
         self.last_options = None
         return self.turns[-1]
 
@@ -146,12 +310,9 @@ class Dialogue:
         return res
     
     def get_dialogue_prompt(self) -> str:
-        res = "Dialogue so far:"
-        last_states = {character: "" for character in self.npcs}
-        for turn in self.turns:
-            res += "\n{}: {}".format(turn.character.name, turn.text)
-            state_info = turn.character.get_state_desc()
-            if turn.character in last_states and state_info != last_states[turn.character]:
-                res += " ({})".format(state_info)
-                last_states[turn.character] = state_info
-        return res
+        if self.dialogue_prompt is None:
+            lines = ["Dialogue so far:"]
+            if self.summary:
+                lines.append("(Summary of earlier dialogue: {})".format(self.summary))
+            self.dialogue_prompt = "\n".join(lines + self.history[self.summarized_turns:])
+        return self.dialogue_prompt
@@ -0,0 +1,89 @@
+from __future__ import annotations
+from typing import Any, Dict, List, Optional
+import json
+import zlib
+import struct
+
+from dialogue import Dialogue, DialogueTurn
+from snapshot import decode_state, encode_turn
+
+
+# a header with the scenario fingerprint, an offset table and one zlib compressed json record per position,
+# so a position is read with a single seek
+MAGIC = b"MCTSGRF"
+VERSION = 1
+HEADER = struct.Struct("<7sB32sI")
+
+
+def encode_part(dialogue: Dialogue) -> Dict[str, Any]:
+    # the latest turn as replayable data, with only the states it changed
+    name, text, changed = encode_turn(dialogue.turns[-1], dialogue.turns[-2] if len(dialogue.turns) > 1 else None)
+    return {"character": name, "text": text, "states": changed, "summary": dialogue.summary, "summarized_turns": dialogue.summarized_turns}
+
+
+def apply_part(dialogue: Dialogue, part: Dict[str, Any]) -> DialogueTurn:
+    characters = {char.name: char for char in dialogue.characters}
+    state = dialogue.get_state()
+    for name, data in part["states"].items():
+        characters[name].state = state[characters[name]] = decode_state(data, characters)
+    dialogue.add_turn(DialogueTurn(characters[part["character"]], part["text"], state))
+    dialogue.summary = part["summary"]
+    dialogue.summarized_turns = part["summarized_turns"]
+    dialogue.dialogue_prompt = None
+    return dialogue.turns[-1]
+
+
+def write_graph(path: str, fingerprint: str, positions: List[Dict[str, Any]]) -> None:
+    blobs = [zlib.compress(json.dumps(position, separators=(",", ":")).encode("utf-8")) for position in positions]
+    offsets = [HEADER.size + 8 * (len(blobs) + 1)]
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+    with open(path, "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, bytes.fromhex(fingerprint), len(blobs)))
+        file.write(struct.pack("<{}Q".format(len(offsets)), *offsets))
+        for blob in blobs:
+            file.write(blob)
+
+
+class DialogueGraph:
+    # positions are the points where the player chooses, each one maps an offered option to the precompiled exchange
+    def __init__(self, path: str):
+        self.path: str = path
+        self.file = open(path, "rb")
+        magic, version, fingerprint, count = HEADER.unpack(self.file.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("{} is not a dialogue graph".format(path))
+        if version != VERSION:
+            raise ValueError("graph version {} is not supported, expected {}".format(version, VERSION))
+        self.fingerprint: str = fingerprint.hex()
+        self.offsets: List[int] = list(struct.unpack("<{}Q".format(count + 1), self.file.read(8 * (count + 1))))
+        self.positions: Dict[int, Dict[str, Any]] = {}
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def get(self, position: int) -> Dict[str, Any]:
+        if position not in self.positions:
+            self.file.seek(self.offsets[position])
+            data = self.file.read(self.offsets[position + 1] - self.offsets[position])
+            self.positions[position] = json.loads(zlib.decompress(data))
+        return self.positions[position]
+
+    def options(self, position: int) -> List[str]:
+        return self.get(position)["options"]
+
+    def edge(self, position: int, text: str) -> Optional[Dict[str, Any]]:
+        edge = self.get(position)["edges"].get(text)
+        if edge is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return edge
+
+    def apply(self, dialogue: Dialogue, part: Dict[str, Any]) -> DialogueTurn:
+        return apply_part(dialogue, part)
+
+    def close(self) -> None:
+        self.file.close()
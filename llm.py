@@ -1,35 +1,214 @@
-from typing import List, Dict
-import os
+from typing import Awaitable, List, Dict, Optional, TypeVar
 import time
-import openai
-openai.api_key = os.environ["OPENAI_API_KEY"]
+import asyncio
+import weakref
+import contextvars
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
+from backends import Backend, OpenAIBackend
+from cache import ResponseCache
+from client import CallBudget, CircuitBreaker, RateLimiter, RetryPolicy
+from telemetry import Telemetry
 
-def get_response(messages: List[Dict[str, str]], model: str = "gpt-3.5-turbo-0125", max_tries=50, temperature=1, stop=["\n", "("], **kwargs) -> str:
-    completion = None
-    num_tries = 0
-    while not completion and num_tries < max_tries:
+
+backend: Backend = None
+max_concurrent_requests: int = 8
+context_limits: Dict[str, int] = {
+    "gpt-3.5-turbo-0125": 16385,
+    "gpt-3.5-turbo": 16385,
+    "gpt-4": 8192,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+}
+default_context_limit: int = 4096
+completion_reserve: int = 256
+response_cache: ResponseCache = ResponseCache()
+retry_policy: RetryPolicy = RetryPolicy()
+rate_limiter: RateLimiter = RateLimiter()
+circuit_breaker: CircuitBreaker = CircuitBreaker()
+telemetry: Telemetry = Telemetry()
+# set by a search so every request made on its behalf, including from spawned tasks, is charged to it
+call_budget: "contextvars.ContextVar[Optional[CallBudget]]" = contextvars.ContextVar("call_budget", default=None)
+_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(max_concurrent_requests)
+    return _semaphores[loop]
+
+
+def get_backend() -> Backend:
+    # the openai backend is only created on first use, so importing this module needs no api key
+    global backend
+    if backend is None:
+        backend = OpenAIBackend()
+    return backend
+
+
+def set_backend(value: Backend) -> None:
+    global backend
+    backend = value
+
+
+async def close() -> None:
+    # releases the backend's connection pool for the running event loop
+    if backend is not None:
+        await backend.close()
+
+
+T = TypeVar("T")
+
+
+def run(main: Awaitable[T]) -> T:
+    # asyncio.run that closes the backend's connections before the loop goes away
+    async def run_and_close() -> T:
         try:
-            completion = openai.ChatCompletion.create(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-                stop=stop,
-                **kwargs
-            ).choices[0].message.content
-            break
+            return await main
+        finally:
+            await close()
+    return asyncio.run(run_and_close())
+
+
+class ContextLengthError(RuntimeError):
+    pass
+
+
+_encodings = {}
+
+
+def count_tokens(text: str, model: str = "gpt-3.5-turbo-0125") -> int:
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            # tiktoken is missing or cannot fetch its vocabulary while offline
+            _encodings[model] = None
+    if _encodings[model] is None:
+        # rough estimate for english text
+        return len(text) // 4 + 1
+    return len(_encodings[model].encode(text))
+
+
+def count_message_tokens(messages: List[Dict[str, str]], model: str = "gpt-3.5-turbo-0125") -> int:
+    # every message carries a few tokens of chat formatting and the reply is primed with three more
+    return sum(count_tokens(message["content"], model) + 4 for message in messages) + 3
+
+
+def get_token_budget(model: str = "gpt-3.5-turbo-0125", max_tokens: int = None) -> int:
+    return context_limits.get(model, default_context_limit) - (max_tokens or completion_reserve)
+
+
+def fit_messages(messages: List[Dict[str, str]], model: str = "gpt-3.5-turbo-0125", max_tokens: int = None) -> List[Dict[str, str]]:
+    budget = get_token_budget(model, max_tokens)
+    while count_message_tokens(messages, model) > budget:
+        # drop the oldest exchange, the system prompt and the latest message are always kept
+        if len(messages) > 3:
+            if messages[0]["role"] == "system":
+                messages = [messages[0]] + messages[3:]
+            else:
+                messages = messages[2:]
+        else:
+            raise ContextLengthError("messages need {} tokens but {} only allows {}".format(count_message_tokens(messages, model), model, budget))
+    return messages
+
+
+async def _request(messages: List[Dict[str, str]], model: str, max_tries: int, temperature: float, stop: List[str], site: str, **kwargs) -> List[str]:
+    tokens = count_message_tokens(messages, model) + (kwargs.get("max_tokens") or completion_reserve) * kwargs.get("n", 1)
+    budget = call_budget.get()
+    if budget is not None:
+        budget.reserve(tokens)
+    start = time.perf_counter()
+    for attempt in range(max_tries):
+        trial = await circuit_breaker.acquire()
+        outcome, error = None, None
+        try:
+            if rate_limiter is not None:
+                await rate_limiter.acquire(tokens)
+            async with _get_semaphore():
+                response = await get_backend().complete(messages, model, temperature, stop, **kwargs)
+            outcome = "success"
         except Exception as e:
-            num_tries += 1
-            print("try {}: {}".format(num_tries, e))
-            if "maximum context length" in str(e):
-                if len(messages) > 3:
-                    if messages[0]["role"] == "system":
-                        messages = [messages[0]] + messages[3:]
-                    else:
-                        messages = messages[2:]
-                else:
-                    raise RuntimeError("messages too long")
-            time.sleep(2)
-    if not completion:
-        raise RuntimeError("Failed to get response from API")
+            error = e
+            if "maximum context length" not in str(e) and retry_policy.classify(e) == "transient":
+                outcome = "failure"
+        finally:
+            # every exit settles the breaker, a trial that is cancelled, rate limited or rejected says nothing about the endpoint
+            if outcome == "success":
+                circuit_breaker.record_success()
+            elif outcome == "failure":
+                circuit_breaker.record_failure()
+            elif trial:
+                circuit_breaker.abandon()
+        if error is not None:
+            if "maximum context length" in str(error):
+                raise ContextLengthError(str(error))
+            if retry_policy.classify(error) == "fatal":
+                telemetry.record_call(site, start, time.perf_counter() - start, retries=attempt, error=error)
+                raise error
+            if attempt + 1 >= max_tries:
+                telemetry.record_call(site, start, time.perf_counter() - start, retries=attempt, error=error)
+                raise RuntimeError("Failed to get response from API") from error
+            delay = retry_policy.delay(attempt, error)
+            print("try {}: {} (retrying in {:.1f}s)".format(attempt + 1, error, delay))
+            await asyncio.sleep(delay)
+            continue
+        if rate_limiter is not None and response.usage:
+            rate_limiter.tokens.refund(tokens - response.usage["total_tokens"])
+        if budget is not None and response.usage:
+            budget.settle(tokens, response.usage["total_tokens"])
+        completions = [text for text in response.texts if text]
+        if completions:
+            telemetry.record_call(site, start, time.perf_counter() - start, usage=response.usage, retries=attempt)
+            return completions
+    error = RuntimeError("Failed to get response from API")
+    telemetry.record_call(site, start, time.perf_counter() - start, retries=max_tries - 1, error=error)
+    raise error
+
+
+async def get_response_async(messages: List[Dict[str, str]], model: str = "gpt-3.5-turbo-0125", max_tries=None, temperature=1, stop=["\n", "("],
+                             site: str = None, cache: bool = None, deadline: float = None, **kwargs) -> str:
+    messages = fit_messages(messages, model, kwargs.get("max_tokens"))
+    key = None
+    if response_cache is not None and response_cache.allowed(site, cache):
+        key = ResponseCache.make_key(model, messages, temperature, stop, kwargs)
+        completion = response_cache.get(key)
+        if completion is not None:
+            telemetry.record_call(site, time.perf_counter(), 0.0, cached=True)
+            return completion
+    start = time.perf_counter()
+    completion = (await _await_request(messages, model, max_tries, temperature, stop, site, deadline, **kwargs))[0]
+    if key is not None:
+        response_cache.put(key, completion, time.perf_counter() - start)
     return completion
+
+
+async def get_responses_async(messages: List[Dict[str, str]], n: int = 1, model: str = "gpt-3.5-turbo-0125", max_tries=None, temperature=1,
+                              stop=["\n", "("], site: str = None, deadline: float = None, **kwargs) -> List[str]:
+    # up to n samples from a single request, never cached since callers want fresh candidates
+    messages = fit_messages(messages, model, kwargs.get("max_tokens"))
+    if n > 1:
+        kwargs["n"] = n
+    return await _await_request(messages, model, max_tries, temperature, stop, site, deadline, **kwargs)
+
+
+async def _await_request(messages: List[Dict[str, str]], model: str, max_tries: int, temperature: float, stop: List[str], site: str,
+                         deadline: float, **kwargs) -> List[str]:
+    start = time.perf_counter()
+    request = _request(messages, model, max_tries or retry_policy.max_tries, temperature, stop, site, **kwargs)
+    try:
+        return await (asyncio.wait_for(request, deadline) if deadline is not None else request)
+    except asyncio.TimeoutError as e:
+        telemetry.record_call(site, start, time.perf_counter() - start, error=e)
+        raise
+
+
+def get_response(messages: List[Dict[str, str]], model: str = "gpt-3.5-turbo-0125", max_tries=None, temperature=1, stop=["\n", "("],
+                 site: str = None, cache: bool = None, deadline: float = None, **kwargs) -> str:
+    return run(get_response_async(messages, model=model, max_tries=max_tries, temperature=temperature, stop=stop, site=site, cache=cache, deadline=deadline, **kwargs))
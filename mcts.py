@@ -1,17 +1,28 @@
 from __future__ import annotations
-from typing import List, Tuple, TYPE_CHECKING
+from typing import Callable, Dict, List, Optional, Tuple, Union, TYPE_CHECKING
 if TYPE_CHECKING:
     from dialogue import Dialogue
     from character import Character
+    from similarity import TalkingPointFilter
+import re
+import math
+import time
 import random
+import asyncio
+from copy import copy
 from tqdm import tqdm
 
-from llm import get_response
+from client import BudgetExceededError, CallBudget
+from llm import call_budget, get_response_async, get_responses_async, telemetry
+from similarity import SimilarityIndex, select_diverse
+from value import ValueEstimator, make_estimator
 
 
 class MCTSNode:
-    def __init__(self, dialogue: str, next: List[Character], parent: MCTSNode, character: Character = None, text: str = ""):
-        self.dialogue: str = dialogue
+    def __init__(self, dialogue: Optional[str], next: List[Character], parent: MCTSNode, character: Character = None, text: str = ""):
+        # only the root stores the dialogue prompt, every other node derives it from its parent on demand
+        self._dialogue: Optional[str] = dialogue
+        self._history: Optional[str] = None
         self.next: List[Character] = next
         self.parent: MCTSNode = parent
         self.children: List[MCTSNode] = []
@@ -20,157 +31,620 @@ class MCTSNode:
         self.visits: int = 0
         self.reward: float = 0.0
         self.done: bool = False
+        self.talking_point: Tuple[Character, str] = None
+        self.pending: int = 0
+        self.expansion: asyncio.Future = None
+        self.expansions: int = 0
+        self.pruned: bool = False
+
+    @property
+    def line(self) -> str:
+        if self.character and self.text:
+            return "{}: {}".format(self.character.name, self.text)
+        return ""
+
+    @property
+    def dialogue(self) -> str:
+        return self._dialogue if self.parent is None else self.parent.history
+
+    @dialogue.setter
+    def dialogue(self, value: str) -> None:
+        self._dialogue = value
+        self.invalidate()
+
+    @property
+    def history(self) -> str:
+        # only nodes with children keep their prompt, leaves are evaluated with a prompt built on demand,
+        # so memory grows with the internal nodes rather than with every node a search has visited
+        if self._history is not None:
+            return self._history
+        line = self.line
+        history = self.dialogue + "\n" + line if line else self.dialogue
+        if self.children:
+            self._history = history
+        return history
+
+    def invalidate(self) -> None:
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node._history is not None:
+                node._history = None
+                stack.extend(node.children)
 
 
 class MCTS:
     def __init__(self, dialogue: Dialogue, is_pc: bool = False, max_iterations: int = 10, num_expand: int = 2,
-                 pc_exand: int = 5, rollout_depth: int = 2, rollout_width: int = 1):
+                 pc_exand: int = 5, rollout_depth: int = 2, rollout_width: int = 1, batch_judge: bool = True,
+                 num_workers: int = 4, time_limit: float = None, max_llm_calls: int = None, max_llm_tokens: int = None,
+                 batch_expand: bool = True, expand_oversample: int = 2, diversity_threshold: float = 0.8,
+                 transpositions: bool = True, transposition_threshold: float = None, estimator: Union[str, ValueEstimator] = "rollout",
+                 value_log: str = None, value_model: str = None, hybrid_top_k: int = 2, exploration: float = 2.0,
+                 progressive_widening: bool = False, widening_constant: float = 1.0, widening_exponent: float = 0.5,
+                 prune_dominated: bool = False, prune_min_visits: int = 3, prune_confidence: float = 1.0):
         self.max_iterations: int = max_iterations
         self.num_expand: int = num_expand
         self.pc_exand: int = pc_exand
         self.rollout_depth: int = rollout_depth
         self.rollout_width: int = rollout_width
         self.is_pc: bool = is_pc
+        self.batch_judge: bool = batch_judge
+        self.batch_expand: bool = batch_expand
+        self.expand_oversample: int = expand_oversample
+        self.diversity_threshold: float = diversity_threshold
+        self.transpositions: bool = transpositions
+        self.transposition_threshold: Optional[float] = transposition_threshold
+        self.table: Dict[Tuple[int, str, str], MCTSNode] = {}
+        self.buckets: Dict[Tuple[int, str], Tuple[SimilarityIndex, List[MCTSNode]]] = {}
+        self.judged: Dict[Tuple[str, str], Optional[Tuple[Character, str]]] = {}
+        self.transposition_stats: Dict[str, int] = {"merged": 0, "judge_reused": 0}
+        self.estimator: ValueEstimator = make_estimator(estimator, value_log, value_model, hybrid_top_k)
+        self.exploration: float = exploration
+        self.progressive_widening: bool = progressive_widening
+        self.widening_constant: float = widening_constant
+        self.widening_exponent: float = widening_exponent
+        self.prune_dominated: bool = prune_dominated
+        self.prune_min_visits: int = prune_min_visits
+        self.prune_confidence: float = prune_confidence
+        self.policy_stats: Dict[str, int] = {"widened": 0, "pruned": 0}
+        self.num_workers: int = num_workers
+        self.time_limit: Optional[float] = time_limit
+        self.max_llm_calls: Optional[int] = max_llm_calls
+        self.max_llm_tokens: Optional[int] = max_llm_tokens
+        self.budget: CallBudget = None
+        self.on_progress: Callable[[List[Tuple[Character, str]]], None] = None
+        self.stop_reason: str = None
+        self.remaining: int = 0
+        self.found: Tuple[Character, str] = None
+        self.iterations: int = 0
+        self.stage_seconds: Dict[str, float] = {}
 
-        self.system_prompt: str = dialogue.get_system_prompt() + "\n\n" + dialogue.get_character_prompt()
-        self.talking_point_prompt: str = dialogue.get_talking_point_prompt()
-        self.pc: Character = dialogue.pc
-        self.npcs: List[Character] = dialogue.npcs
-        self.talking_points: List[str] = ["{}: {}".format(tp.character.name, text) for tp in dialogue.get_next_talking_points() for text in tp.targets]
+        self.refresh(dialogue)
         self.root = MCTSNode(
             dialogue.get_dialogue_prompt(),
             [dialogue.pc] if is_pc else dialogue.npcs,
             None
         )
 
-    def check_talking_points(self, node: MCTSNode) -> Tuple[Character, str]:
+    def refresh(self, dialogue: Dialogue) -> None:
+        self.system_prompt: str = dialogue.get_system_prompt() + "\n\n" + dialogue.get_character_prompt()
+        self.talking_point_prompt: str = dialogue.get_talking_point_prompt()
+        self.pc: Character = dialogue.pc
+        self.npcs: List[Character] = dialogue.npcs
+        self.talking_points: List[str] = ["{}: {}".format(tp.character.name, text) for tp in dialogue.get_next_talking_points() for text in tp.targets]
+        self.prefilter: TalkingPointFilter = dialogue.prefilter
+
+    def reroot(self, dialogue: Dialogue, character: Character, text: str) -> bool:
+        # keep the subtree under the move that was actually made, rebuilding its prompts from the updated dialogue
+        node = next((child for child in self.root.children if child.character == character and child.text == text), None)
+        talking_points = self.talking_points
+        self.refresh(dialogue)
+        if node is None or self.talking_points != talking_points:
+            return False
+        node.parent = None
+        node.character = None
+        node.text = ""
+        node.dialogue = dialogue.get_dialogue_prompt()
+        self.root = node
+        self.is_pc = node.next == [self.pc]
+        self.rebuild_table()
+        return True
+
+    def fork(self) -> MCTS:
+        # a copy with its own nodes and bookkeeping, so a speculative search can re-root and grow it without touching this tree
+        fork = copy(self)
+        clones = {}
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if id(node) in clones:
+                continue
+            clone = clones[id(node)] = copy(node)
+            clone.pending, clone.expansion = 0, None
+            stack.extend(node.children)
+        for clone in clones.values():
+            clone.children = [clones[id(child)] for child in clone.children]
+            if clone.parent is not None:
+                clone.parent = clones.get(id(clone.parent))
+        fork.root = clones[id(self.root)]
+        fork.judged = dict(self.judged)
+        fork.transposition_stats = dict(self.transposition_stats)
+        fork.policy_stats = dict(self.policy_stats)
+        fork.stage_seconds = dict(self.stage_seconds)
+        fork.estimator = copy(self.estimator)
+        fork.estimator.reset()
+        fork.budget = None
+        fork.rebuild_table()
+        return fork
+
+    def get_depth(self, node: MCTSNode) -> int:
+        depth = 0
+        while node.parent is not None:
+            node = node.parent
+            depth += 1
+        return depth
+
+    def get_key(self, depth: int, character: Character, text: str) -> Tuple[int, str, str]:
+        return (depth, character.name, SimilarityIndex.normalize(text))
+
+    def lookup(self, key: Tuple[int, str, str]) -> Optional[MCTSNode]:
+        if key in self.table or self.transposition_threshold is None or key[:2] not in self.buckets:
+            return self.table.get(key)
+        index, nodes = self.buckets[key[:2]]
+        scores = index.scores(key[2])
+        best = int(scores.argmax()) if len(scores) else -1
+        return nodes[best] if best >= 0 and scores[best] >= self.transposition_threshold else None
+
+    def remember(self, key: Tuple[int, str, str], node: MCTSNode) -> None:
+        self.table[key] = node
+        if self.transposition_threshold is not None:
+            if key[:2] not in self.buckets:
+                self.buckets[key[:2]] = (SimilarityIndex([]), [])
+            index, nodes = self.buckets[key[:2]]
+            index.add([key[2]])
+            nodes.append(node)
+
+    def rebuild_table(self) -> None:
+        # merged nodes keep the parent they were created under for their prompt, links into discarded branches are cut
+        # so every node left has a parent chain ending at the new root
+        self.table, self.buckets = {}, {}
+        owned = {id(self.root): True}
+        def is_owned(node: MCTSNode) -> bool:
+            chain = []
+            while id(node) not in owned and node.parent is not None:
+                chain.append(node)
+                node = node.parent
+            result = owned.get(id(node), False)
+            for visited in chain:
+                owned[id(visited)] = result
+            return result
+        seen, queue = {id(self.root)}, [(self.root, 0)]
+        while queue:
+            node, depth = queue.pop(0)
+            if any(not is_owned(child) for child in node.children):
+                node.children = [child for child in node.children if is_owned(child)]
+            for child in node.children:
+                if id(child) not in seen:
+                    seen.add(id(child))
+                    self.remember(self.get_key(depth + 1, child.character, child.text), child)
+                    queue.append((child, depth + 1))
+
+    def get_talking_point(self, tp: str) -> Tuple[Character, str]:
+        character = tp.split(":")[0].strip()
+        character = [c for c in self.npcs if c.name == character][0]
+        text = ":".join(tp.split(":")[1:]).strip()
+        return character, text
+
+    def parse_match(self, res: str, talking_points: List[str] = None) -> Optional[int]:
+        # returns the index of the matched talking point, -1 for no match and None if the answer is unusable
+        # an explicit "Match:" answer wins, echoed target text is only trusted when the judge gave none
+        talking_points = self.talking_points if talking_points is None else talking_points
+        # tolerates markdown and numbering around the answer, as in "**Match:** 2", "Match: #2" or "Match: Target 2"
+        match = re.search(r"match\W*(?:target(?:\s+text)?\s*)?#?\s*(\d+|none|no)\b", res, re.IGNORECASE)
+        if match is None:
+            targets = [tp.split(":", 1)[-1].strip().lower() for tp in talking_points]
+            for i in sorted(range(len(targets)), key=lambda i: len(targets[i]), reverse=True):
+                if targets[i] and targets[i] in res.lower():
+                    return i
+        answer = match.group(1).lower() if match else res.strip().lower()
+        if answer.isdigit():
+            index = int(answer)
+            if index == 0:
+                return -1
+            return index - 1 if index <= len(talking_points) else None
+        if answer.startswith("none") or answer.startswith("no"):
+            return -1
+        return None
+
+    async def check_talking_points(self, node: MCTSNode) -> Tuple[Character, str]:
+        talking_points = self.talking_points
+        if self.prefilter is not None and talking_points:
+            # clear matches and clear misses are decided locally, only ambiguous targets reach the judge
+            texts = [self.get_talking_point(tp)[1] for tp in talking_points]
+            match, ambiguous = self.prefilter.screen(node.text, texts)
+            if match is not None:
+                return self.get_talking_point(talking_points[texts.index(match)])
+            talking_points = [tp for tp, text in zip(talking_points, texts) if text in ambiguous]
+        if not talking_points:
+            return None
+        if self.batch_judge and len(talking_points) > 1:
+            message = node.dialogue
+            message += "\n\nIn the context of the above conversation, is the following output semantically similar to or encapsulate any of the numbered target texts?"
+            message += "\n\nOutput: " + node.text
+            message += "\n\nTarget texts:"
+            for i, tp in enumerate(talking_points):
+                message += "\n{}. {}".format(i + 1, tp)
+            message += "\n\nUse the format \"Match: number of the matching target text\", or \"Match: none\" if no target text matches."
+            res = await get_response_async([
+                dict(role="system", content=self.system_prompt),
+                dict(role="user", content=message)
+            ], site="judge")
+            index = self.parse_match(res, talking_points)
+            if index is not None:
+                return self.get_talking_point(talking_points[index]) if index >= 0 else None
+
         message = node.dialogue
         message += "\n\nIn the context of the above conversation, is the following output semantically similar to or encapsulate the target text? Output yes or no."
         message += "\n\nOutput: " + node.text
-        for tp in self.talking_points:
-            message + "\n\nTarget text: " + tp
-            res = get_response([
+        responses = await asyncio.gather(*[
+            get_response_async([
                 dict(role="system", content=self.system_prompt),
                 dict(role="user", content=message + "\n\nTarget text: " + tp)
-            ])
+            ], site="judge")
+            for tp in talking_points
+        ])
+        for tp, res in zip(talking_points, responses):
             if "yes" in res.lower():
-                character = tp.split(":")[0].strip()
-                character = [c for c in self.npcs if c.name == character][0]
-                text = ":".join(tp.split(":")[1:]).strip()
-                return character, text
+                return self.get_talking_point(tp)
         return None
 
-    def search(self) -> List[Tuple[Character, str]]:
-        for _ in range(self.max_iterations):
-            node = self.select()
-            if not node.done and (node.parent is None or node.visits > 0):
-                node = self.expand(node, self.pc_exand if self.is_pc and node.parent is None else self.num_expand)
+    def get_tree_stats(self) -> Dict[str, float]:
+        nodes, edges, expanded, unvisited, depth = 0, 0, 0, 0, 0
+        seen, stack = {id(self.root)}, [(self.root, 0)]
+        while stack:
+            node, level = stack.pop()
+            nodes += 1
+            edges += len(node.children)
+            expanded += bool(node.children)
+            unvisited += node.visits == 0
+            depth = max(depth, level)
+            for child in node.children:
+                if id(child) not in seen:
+                    seen.add(id(child))
+                    stack.append((child, level + 1))
+        return {
+            "nodes": nodes,
+            "depth": depth,
+            "branching": edges / expanded if expanded else 0.0,
+            "root_visits": self.root.visits,
+            "unvisited": unvisited,
+            "shared_links": edges - (nodes - 1),
+        }
+
+    def get_transposition_stats(self, since: Dict[str, int] = None) -> Dict[str, int]:
+        # every merge skips at least the first rollout call and every reused verdict at least one judge call
+        stats = {key: value - (since or {}).get(key, 0) for key, value in self.transposition_stats.items()}
+        stats["calls_saved"] = stats["merged"] + stats["judge_reused"]
+        return stats
+
+    async def judge(self, node: MCTSNode) -> Optional[Tuple[Character, str]]:
+        # the talking points are fixed for the lifetime of a tree, so an equivalent line is only ever judged once
+        key = (node.character.name, SimilarityIndex.normalize(node.text))
+        if key in self.judged:
+            self.transposition_stats["judge_reused"] += 1
+            return self.judged[key]
+        tp = await self.check_talking_points(node)
+        self.judged[key] = tp
+        return tp
+
+    def ranking(self) -> List[Tuple[Character, str]]:
+        # visit normalized value, safe to call while a search is still running
+        def value(node: MCTSNode) -> Tuple[float, int]:
+            return (node.reward / node.visits if node.visits else float("-inf"), node.visits)
+        sorted_children = sorted(self.root.children, key=value, reverse=True)
+        return [(x.character, x.text) for x in sorted_children]
+
+    async def search(self, on_progress: Callable[[List[Tuple[Character, str]]], None] = None) -> List[Tuple[Character, str]]:
+        start = time.perf_counter()
+        deadline = start + self.time_limit if self.time_limit is not None else None
+        self.iterations = 0
+        self.stage_seconds = {"expand": 0.0, "judge": 0.0, "rollout": 0.0}
+        self.on_progress = on_progress
+        self.stop_reason = "iterations"
+        self.budget = CallBudget(self.max_llm_calls, self.max_llm_tokens)
+        self.estimator.reset()
+        transpositions = dict(self.transposition_stats)
+        policy = dict(self.policy_stats)
+        # a reused tree already carries the visits of earlier searches
+        self.found = next((child.talking_point for child in self.root.children if child.talking_point), None)
+        if self.found is None:
+            self.remaining = max(self.max_iterations - self.root.visits, 0 if self.root.children else 1)
+            token = call_budget.set(self.budget)
+            try:
+                workers = {asyncio.ensure_future(self.work()) for _ in range(max(min(self.num_workers, self.remaining), 1))}
+            finally:
+                call_budget.reset(token)
+            try:
+                while workers and self.found is None:
+                    timeout = max(deadline - time.perf_counter(), 0) if deadline is not None else None
+                    done, workers = await asyncio.wait(workers, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                    for worker in done:
+                        worker.result()
+                    if deadline is not None and time.perf_counter() >= deadline and workers:
+                        # without any children there is nothing to return, so the first expansion is always waited for
+                        if not self.root.children and self.root.expansion is not None:
+                            await asyncio.shield(self.root.expansion)
+                        self.stop_reason = "deadline"
+                        break
+            finally:
+                # cancelling a worker unwinds its in-flight llm calls and virtual loss
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+        if self.found:
+            self.stop_reason = "talking_point"
+        if telemetry.enabled:
+            telemetry.record_search(dict(
+                self.get_tree_stats(),
+                start=start,
+                duration=time.perf_counter() - start,
+                is_pc=self.is_pc,
+                iterations=self.iterations,
+                early_exit=self.found is not None,
+                stop_reason=self.stop_reason,
+                llm_calls=self.budget.calls,
+                transpositions=self.get_transposition_stats(transpositions),
+                estimator=self.estimator.name,
+                policy={key: value - policy[key] for key, value in self.policy_stats.items()},
+                llm_tokens=self.budget.tokens,
+                stages=dict(self.stage_seconds),
+            ))
+        if self.found:
+            return [self.found]
+        return self.ranking()
+
+    async def work(self) -> None:
+        while self.remaining > 0 and self.found is None:
+            self.remaining -= 1
+            self.iterations += 1
+            try:
+                await self.iterate()
+            except BudgetExceededError:
+                self.remaining = 0
+                self.stop_reason = "budget"
+                return
+            if self.on_progress is not None:
+                self.on_progress(self.ranking())
+
+    async def iterate(self) -> None:
+        path = self.select()
+        node = path[-1]
+        # virtual loss keeps concurrent workers from piling onto the nodes this iteration is evaluating
+        for visited in path:
+            visited.pending += 1
+        try:
+            if not node.done and (len(path) == 1 or node.visits > 0):
+                # with progressive widening one new line per speaker at a time, select only stops at an expanded node once it may widen
+                num_expand = 1 if self.progressive_widening else self.get_num_expand(node)
+                if node.expansion is None:
+                    node.expansion = asyncio.get_running_loop().create_future()
+                    self.policy_stats["widened"] += bool(node.children)
+                    # like the deadline, the budget never stops the first root expansion since without children there is nothing to return
+                    first = node is self.root and not node.children
+                    if first:
+                        self.budget.enforce = False
+                    try:
+                        started = time.perf_counter()
+                        child = await self.expand(node, num_expand)
+                        self.stage_seconds["expand"] += time.perf_counter() - started
+                    finally:
+                        if first:
+                            self.budget.enforce = True
+                        expansion, node.expansion = node.expansion, None
+                        expansion.set_result(None)
+                else:
+                    await asyncio.shield(node.expansion)
+                    if not node.children:
+                        return
+                    child = min(node.children, key=lambda x: x.visits + x.pending)
+                if child is None:
+                    return
+                node = child
+                node.pending += 1
+                path.append(node)
             reward = None
             if node.text and node.character in self.npcs:
-                tp = self.check_talking_points(node)
-                if tp and node.parent.parent is None:
-                    return [tp]
+                started = time.perf_counter()
+                tp = node.talking_point or await self.judge(node)
+                self.stage_seconds["judge"] += time.perf_counter() - started
+                if tp and len(path) == 2:
+                    self.found = tp
+                    return
                 elif tp:
                     node.done = True
+                    node.talking_point = tp
                     reward = 1
             if reward is None:
-                reward = self.rollout(node)
-            self.backpropagate(node, reward)
-        sorted_children = sorted(self.root.children, key=lambda x: x.reward, reverse=True)
-        return [(x.character, x.text) for x in sorted_children]
+                started = time.perf_counter()
+                reward = await self.estimator.estimate(self, node)
+                self.stage_seconds["rollout"] += time.perf_counter() - started
+            self.backpropagate(path, reward)
+        finally:
+            for visited in path:
+                visited.pending -= 1
 
-    def select(self) -> MCTSNode:
-        def ucb(node: MCTSNode) -> float:
-            if node.visits == 0:
+    def select(self) -> List[MCTSNode]:
+        def ucb(node: MCTSNode, parent: MCTSNode) -> float:
+            visits = node.visits + node.pending
+            if visits == 0:
                 return float("inf")
-            return node.reward / node.visits + 2 * (2 * node.parent.visits / node.visits) ** 0.5
-        node = self.root
-        while node.children and node.visits > 0:
-            node = max(node.children, key=lambda x: ucb(x))
-        return node
-
-    def expand(self, parent: MCTSNode, num_expand: int) -> MCTSNode:
-        for character in parent.next:
-            dialogue = parent.dialogue
-            if parent.character and parent.text:
-                dialogue += "\n{}: {}".format(parent.character.name, parent.text)
+            return node.reward / visits + self.exploration * (2 * (parent.visits + parent.pending) / visits) ** 0.5
+        path = [self.root]
+        while path[-1].children and path[-1].visits > 0:
+            node = path[-1]
+            if self.can_widen(node):
+                break
+            if self.prune_dominated:
+                self.prune(node)
+            path.append(max([child for child in node.children if not child.pruned] or node.children, key=lambda x: ucb(x, node)))
+        return path
 
-            message = dialogue
+    def get_num_expand(self, node: MCTSNode) -> int:
+        return self.pc_exand if self.is_pc and node is self.root else self.num_expand
+
+    def can_widen(self, node: MCTSNode) -> bool:
+        # progressive widening, a node may hold about widening_constant * visits ** widening_exponent children
+        if not self.progressive_widening or node.done or node.expansion is not None or node.expansions >= self.get_num_expand(node):
+            return False
+        allowed = max(1, math.ceil(self.widening_constant * node.visits ** self.widening_exponent))
+        return len(node.children) < min(allowed * len(node.next), self.get_num_expand(node) * len(node.next))
+
+    def prune(self, parent: MCTSNode) -> None:
+        # drops children whose optimistic value is below the pessimistic value of the best sibling
+        bounds = [
+            (child, child.reward / child.visits, self.prune_confidence * (math.log(max(parent.visits, 2)) / (2 * child.visits)) ** 0.5)
+            for child in parent.children if child.visits >= self.prune_min_visits and not child.pruned
+        ]
+        if len(bounds) < 2:
+            return
+        best = max(mean - bound for _, mean, bound in bounds)
+        for child, mean, bound in bounds:
+            if mean + bound < best:
+                child.pruned = True
+                self.policy_stats["pruned"] += 1
+
+    async def expand(self, parent: MCTSNode, num_expand: int) -> MCTSNode:
+        # adds up to num_expand children per next speaker, later calls widen the node with lines unlike its current children
+        async def expand_character(character: Character) -> Tuple[Character, List[str]]:
+            existing = [child.text for child in parent.children if child.character == character]
+            message = parent.history
             if character in self.npcs:
                 message = self.talking_point_prompt + "\n\n" + message
             message += "\n\nContinue the conversation with a message from {}.".format(character.name)
             message += "\nUse the format \"{}: message\"".format(character.name)
 
-            for i in range(num_expand):
-                res = get_response([
+            if self.batch_expand:
+                # oversample in one request and keep the most varied candidates
+                responses = await get_responses_async([
+                    dict(role="system", content=self.system_prompt),
+                    dict(role="user", content=message)
+                ], n=num_expand * self.expand_oversample if num_expand > 1 or existing else 1, site="expand")
+                texts = [res.split("{}:".format(character.name))[-1].strip() for res in responses]
+                return character, select_diverse(texts, num_expand, self.diversity_threshold, keep=existing)
+
+            # the first response seeds the dissimilarity prompt, the rest can be requested together
+            responses = []
+            if not existing:
+                responses.append(await get_response_async([
                     dict(role="system", content=self.system_prompt),
                     dict(role="user", content=message)
+                ], site="expand"))
+                existing = [responses[0]]
+            if num_expand > len(responses):
+                message += "\n\nMake your response very disimilar from the following examples:"
+                message += "".join("\n" + text for text in existing)
+                responses += await asyncio.gather(*[
+                    get_response_async([
+                        dict(role="system", content=self.system_prompt),
+                        dict(role="user", content=message)
+                    ], site="expand")
+                    for _ in range(num_expand - len(responses))
                 ])
-                if i == 0:
-                    message += "\n\nMake your response very disimilar from the following examples:"
-                message += "\n" + res
+            return character, [res.split("{}:".format(character.name))[-1].strip() for res in responses]
+
+        parent.expansions += 1
+        added = []
+        depth = self.get_depth(parent) + 1
+        for character, texts in await asyncio.gather(*[expand_character(c) for c in parent.next]):
+            for text in texts:
+                key = self.get_key(depth, character, text)
+                existing = self.lookup(key) if self.transpositions else None
+                if existing is not None:
+                    # an equivalent position already exists, link it so both paths share its statistics
+                    if existing not in parent.children:
+                        parent.children.append(existing)
+                        added.append(existing)
+                        self.transposition_stats["merged"] += 1
+                    continue
                 child = MCTSNode(
-                    dialogue,
+                    None,
                     self.npcs if character == self.pc else [self.pc],
                     parent,
                     character=character,
-                    text = res.split("{}:".format(character.name))[-1].strip()
+                    text=text
                 )
                 parent.children.append(child)
-        return parent.children[0]
+                added.append(child)
+                if self.transpositions:
+                    self.remember(key, child)
+        if added:
+            return added[0]
+        return min(parent.children, key=lambda x: x.visits + x.pending) if parent.children else None
     
-    def rollout(self, node: MCTSNode) -> float:
-        dialogue = node.dialogue
-        if node.character and node.text:
-            dialogue += "\n{}: {}".format(node.character.name, node.text)
+    async def rollout(self, node: MCTSNode) -> float:
+        dialogue = node.history
 
-        def add_pc_turn(dialogue):
+        async def add_pc_turn(dialogue):
             message = dialogue
             message += "\n\nContinue the conversation with a message from {}. Use the format: \"{}: message\"".format(self.pc.name, self.pc.name)
-            res = get_response([
+            res = await get_response_async([
                 dict(role="system", content=self.system_prompt),
                 dict(role="user", content=message)
-            ])
+            ], site="rollout")
             dialogue += "\n" + res
             return dialogue
         
         if node.character in self.npcs:
-            dialogue = add_pc_turn(dialogue)
+            dialogue = await add_pc_turn(dialogue)
 
         for i in range(self.rollout_depth):
             message = dialogue
             message += "\n\nContinue the conversation above with a new message. Use the format: \"name: message\""
 
-            outputs = []
-            for _ in range(self.rollout_width):
-                res = get_response([
+            if self.batch_expand:
+                outputs = await get_responses_async([
+                    dict(role="system", content=self.system_prompt),
+                    dict(role="user", content=message)
+                ], n=self.rollout_width, site="rollout")
+                outputs = select_diverse(outputs, self.rollout_width, self.diversity_threshold)
+            else:
+                outputs = [await get_response_async([
                     dict(role="system", content=self.system_prompt),
                     dict(role="user", content=message)
+                ], site="rollout")]
+            if not self.batch_expand and self.rollout_width > 1:
+                message += "\n\nMake your response very disimilar from the following examples:"
+                message += "\n" + outputs[0]
+                outputs += await asyncio.gather(*[
+                    get_response_async([
+                        dict(role="system", content=self.system_prompt),
+                        dict(role="user", content=message)
+                    ], site="rollout")
+                    for _ in range(self.rollout_width - 1)
                 ])
-                if len(outputs) == 0:
-                    message += "\n\nMake your response very disimilar from the following examples:"
-                message += "\n" + res
-                outputs.append(res)
 
-            for tp in self.talking_points:
+            async def judge(tp: str) -> str:
                 message = dialogue
                 message += "\n\nDoes the first output below do a better, worse, or equal job of continuing the above conversation than the the best of the alternative output(s)?"
                 message += "\n\nOutput: " + tp
                 message += "\n\nAlternative Output(s):\n" + "\n".join(outputs)
-                res = get_response([
+                return await get_response_async([
                     dict(role="system", content=self.system_prompt),
                     dict(role="user", content=message)
-                ])
+                ], site="rollout_judge")
+
+            for res in await asyncio.gather(*[judge(tp) for tp in self.talking_points]):
                 if "equal" in res.lower() or "better" in res.lower():
                     return .9 ** i
             
             dialogue += "\n" + outputs[0]
-            dialogue = add_pc_turn(dialogue)
+            dialogue = await add_pc_turn(dialogue)
 
         return 0
 
-    def backpropagate(self, node: MCTSNode, reward: float) -> None:
-        while node:
+    def backpropagate(self, path: List[MCTSNode], reward: float) -> None:
+        # follows the selected path since merged nodes have several parents, runs without awaiting so concurrent
+        # workers never observe a half-applied update
+        for node in path:
             node.visits += 1
             node.reward += reward
-            node: MCTSNode = node.parent
@@ -0,0 +1,80 @@
+from typing import Any, Dict, List, Optional, Tuple
+import time
+import asyncio
+import argparse
+
+import llm
+from backends import MockBackend
+from dialogue import Dialogue
+from graph import encode_part, write_graph
+
+
+async def compile_scenario(scenario_path: str, output_path: str, depth: int = 2, search_settings: Dict[str, Any] = None,
+                           concurrency: int = 4) -> List[Dict[str, Any]]:
+    # breadth first over the options the search ranks highest, each exchange is played on a fork of its position
+    root = Dialogue()
+    root.load(scenario_path)
+    root.search_settings = dict(search_settings or {})
+    semaphore = asyncio.Semaphore(concurrency)
+    positions: List[Dict[str, Any]] = []
+    level = [(root, len(positions))]
+    positions.append({"options": [], "edges": {}})
+
+    async def explore(dialogue: Dialogue, option: str) -> Optional[Tuple[Dialogue, Dict[str, Any]]]:
+        async with semaphore:
+            fork = dialogue.fork()
+            try:
+                await fork.add_pc_turn(option)
+                pc = encode_part(fork)
+                await fork.take_npc_turn()
+            except Exception as e:
+                print("skipping {!r}: {}".format(option, e))
+                return None
+            return fork, {
+                "pc": pc,
+                "npc": encode_part(fork),
+                "talking_points": [tp.targets[0] for tp in fork.talking_points],
+                "next": None,
+            }
+
+    for current in range(depth):
+        async def options(dialogue: Dialogue) -> List[str]:
+            async with semaphore:
+                return await dialogue.get_pc_options()
+        offered = await asyncio.gather(*[options(dialogue) for dialogue, _ in level])
+        explored = iter(await asyncio.gather(*[explore(dialogue, option) for (dialogue, _), opts in zip(level, offered) for option in opts]))
+        next_level = []
+        for (dialogue, index), opts in zip(level, offered):
+            positions[index]["options"] = opts
+            for option in opts:
+                result = next(explored)
+                if result is None:
+                    continue
+                fork, edge = result
+                if current + 1 < depth and fork.talking_points:
+                    edge["next"] = len(positions)
+                    positions.append({"options": [], "edges": {}})
+                    next_level.append((fork, edge["next"]))
+                positions[index]["edges"][option] = edge
+        level = next_level
+    write_graph(output_path, root.fingerprint, positions)
+    return positions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenario", nargs="?", default="dialogue.json")
+    parser.add_argument("output", nargs="?", default="dialogue.graph")
+    parser.add_argument("--depth", type=int, default=2, help="player turns to precompile along every path")
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--mock", action="store_true", help="answer from MockBackend instead of the openai api")
+    args = parser.parse_args()
+
+    if args.mock:
+        llm.set_backend(MockBackend())
+        llm.rate_limiter = None
+    start = time.perf_counter()
+    positions = llm.run(compile_scenario(args.scenario, args.output, args.depth, dict(max_iterations=args.iterations), args.concurrency))
+    print("compiled {} positions and {} exchanges into {} in {:.1f}s".format(
+        len(positions), sum(len(position["edges"]) for position in positions), args.output, time.perf_counter() - start))
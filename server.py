@@ -0,0 +1,305 @@
+from typing import Any, Dict, List, Optional, Tuple
+import os
+import json
+import time
+import uuid
+import asyncio
+import argparse
+from collections import deque
+
+import llm
+import snapshot
+from backends import MockBackend
+from dialogue import Dialogue, DialogueTurn
+from graph import DialogueGraph
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status: int = status
+
+
+class Session:
+    def __init__(self, session_id: str, dialogue: Dialogue):
+        self.id: str = session_id
+        self.dialogue: Dialogue = dialogue
+        self.lock: asyncio.Lock = asyncio.Lock()
+        self.created: float = time.monotonic()
+        self.last_used: float = self.created
+        self.turns: int = 0
+
+
+class SessionManager:
+    # every session shares the process wide llm client, so the rate limiter, connection pool and response cache are common to all
+    def __init__(self, scenario_path: str = "dialogue.json", idle_timeout: float = 600.0, max_sessions: int = None,
+                 search_settings: Dict[str, Any] = None, speculate: bool = False, snapshot_dir: str = None,
+                 graph: DialogueGraph = None):
+        self.scenario_path: str = scenario_path
+        self.idle_timeout: float = idle_timeout
+        self.max_sessions: Optional[int] = max_sessions
+        self.search_settings: Dict[str, Any] = search_settings or {}
+        self.speculate: bool = speculate
+        self.snapshot_dir: Optional[str] = snapshot_dir
+        self.graph: Optional[DialogueGraph] = graph
+        self.sessions: Dict[str, Session] = {}
+        self.started: float = time.monotonic()
+        self.sessions_served: int = 0
+        self.sessions_evicted: int = 0
+        self.turns: int = 0
+        self.recent_turns: deque = deque()
+        self.waiting: int = 0
+        self.running: int = 0
+        self.evictor: asyncio.Task = None
+
+    def create(self, scenario: Dict[str, Any] = None) -> Session:
+        if self.max_sessions is not None and len(self.sessions) >= self.max_sessions:
+            self.evict_idle()
+            if len(self.sessions) >= self.max_sessions:
+                raise HTTPError(503, "session limit of {} reached".format(self.max_sessions))
+        dialogue = Dialogue()
+        if scenario is not None:
+            dialogue.load_data(scenario)
+        else:
+            dialogue.load(self.scenario_path)
+        dialogue.search_settings = dict(self.search_settings)
+        if self.graph is not None and self.graph.fingerprint == dialogue.fingerprint:
+            dialogue.use_graph(self.graph)
+        session = Session(uuid.uuid4().hex, dialogue)
+        self.sessions[session.id] = session
+        self.sessions_served += 1
+        return session
+
+    def get(self, session_id: str) -> Session:
+        if session_id not in self.sessions:
+            path = self.get_snapshot_path(session_id)
+            if path is None or not os.path.exists(path):
+                raise HTTPError(404, "unknown session {}".format(session_id))
+            # page an evicted session back in, at the graph position it was evicted at
+            self.sessions[session_id] = Session(session_id, snapshot.restore(path, self.graph))
+        return self.sessions[session_id]
+
+    def get_snapshot_path(self, session_id: str) -> Optional[str]:
+        if self.snapshot_dir is None or not session_id.isalnum():
+            return None
+        return os.path.join(self.snapshot_dir, session_id + ".snap")
+
+    def close(self, session_id: str) -> None:
+        self.get(session_id).dialogue.cancel_speculations()
+        del self.sessions[session_id]
+        path = self.get_snapshot_path(session_id)
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+    def page_out(self, session_id: str) -> None:
+        # idle sessions go to disk when there is a snapshot directory and are dropped otherwise,
+        # a session is only let go of once its snapshot is written
+        session = self.sessions[session_id]
+        session.dialogue.cancel_speculations()
+        path = self.get_snapshot_path(session_id)
+        if path is not None:
+            snapshot.save(session.dialogue, path, include_tree=True)
+        del self.sessions[session_id]
+
+    def evict_idle(self) -> int:
+        now = time.monotonic()
+        idle = [session_id for session_id, session in self.sessions.items()
+                if now - session.last_used > self.idle_timeout and not session.lock.locked()]
+        evicted = 0
+        for session_id in idle:
+            try:
+                self.page_out(session_id)
+            except Exception as e:
+                print("keeping session {} in memory, paging it out failed: {!r}".format(session_id, e))
+                continue
+            evicted += 1
+        self.sessions_evicted += evicted
+        return evicted
+
+    async def run_evictor(self) -> None:
+        while True:
+            await asyncio.sleep(max(self.idle_timeout / 4, 0.1))
+            try:
+                self.evict_idle()
+            except Exception as e:
+                print("eviction failed, retrying next round: {!r}".format(e))
+
+    async def options(self, session_id: str) -> List[str]:
+        async with self.use(session_id) as session:
+            options = await session.dialogue.get_pc_options()
+            if self.speculate:
+                session.dialogue.speculate()
+            return options
+
+    async def pc_turn(self, session_id: str, text: str) -> DialogueTurn:
+        async with self.use(session_id) as session:
+            turn = await session.dialogue.add_pc_turn(text)
+            self.count_turn(session)
+            return turn
+
+    async def npc_turn(self, session_id: str) -> DialogueTurn:
+        async with self.use(session_id) as session:
+            turn = await session.dialogue.take_npc_turn()
+            self.count_turn(session)
+            return turn
+
+    def use(self, session_id: str) -> "SessionUse":
+        return SessionUse(self, self.get(session_id))
+
+    def count_turn(self, session: Session) -> None:
+        now = time.monotonic()
+        session.turns += 1
+        self.turns += 1
+        self.recent_turns.append(now)
+
+    def metrics(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        while self.recent_turns and now - self.recent_turns[0] > 60:
+            self.recent_turns.popleft()
+        window = min(60.0, now - self.started)
+        return {
+            "uptime": now - self.started,
+            "sessions_active": len(self.sessions),
+            "sessions_served": self.sessions_served,
+            "sessions_evicted": self.sessions_evicted,
+            "turns": self.turns,
+            "turns_per_second": len(self.recent_turns) / window if window > 0 else 0.0,
+            "queue_depth": self.waiting,
+            "running": self.running,
+            "cache": llm.response_cache.stats if llm.response_cache is not None else None,
+            "circuit": llm.circuit_breaker.state,
+            "graph": {"hits": self.graph.hits, "misses": self.graph.misses} if self.graph is not None else None,
+        }
+
+
+class SessionUse:
+    # serializes operations on one session and keeps the queue depth and idle clock up to date
+    def __init__(self, manager: SessionManager, session: Session):
+        self.manager: SessionManager = manager
+        self.session: Session = session
+
+    async def __aenter__(self) -> Session:
+        self.manager.waiting += 1
+        try:
+            await self.session.lock.acquire()
+        finally:
+            self.manager.waiting -= 1
+        self.manager.running += 1
+        return self.session
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.manager.running -= 1
+        self.session.last_used = time.monotonic()
+        self.session.lock.release()
+
+
+def turn_to_dict(turn: DialogueTurn) -> Dict[str, str]:
+    return {"character": turn.character.name, "text": turn.text}
+
+
+class DialogueServer:
+    def __init__(self, manager: SessionManager, host: str = "127.0.0.1", port: int = 8080):
+        self.manager: SessionManager = manager
+        self.host: str = host
+        self.port: int = port
+        self.server: asyncio.AbstractServer = None
+
+    async def start(self) -> Tuple[str, int]:
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.manager.evictor = asyncio.ensure_future(self.manager.run_evictor())
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def stop(self) -> None:
+        self.manager.evictor.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+        await llm.close()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # http/1.1 with keep alive, enough for json clients without pulling in a web framework
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode("latin-1").strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                try:
+                    status, payload = 200, await self.route(method, path.split("?")[0], json.loads(body) if body else {})
+                except HTTPError as e:
+                    status, payload = e.status, {"error": str(e)}
+                except json.JSONDecodeError as e:
+                    status, payload = 400, {"error": "invalid json: {}".format(e)}
+                except Exception as e:
+                    status, payload = 500, {"error": repr(e)}
+                data = json.dumps(payload).encode("utf-8")
+                writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n".format(
+                    status, "OK" if status == 200 else "Error", len(data)).encode("latin-1") + data)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method: str, path: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        parts = [part for part in path.split("/") if part]
+        if method == "GET" and parts == ["metrics"]:
+            return self.manager.metrics()
+        if method == "POST" and parts == ["sessions"]:
+            session = self.manager.create(body.get("scenario"))
+            return {"session": session.id, "turns": [turn_to_dict(turn) for turn in session.dialogue.turns]}
+        if len(parts) == 2 and parts[0] == "sessions" and method == "DELETE":
+            self.manager.close(parts[1])
+            return {}
+        if len(parts) == 3 and parts[0] == "sessions":
+            session_id, action = parts[1], parts[2]
+            if method == "GET" and action == "options":
+                return {"options": await self.manager.options(session_id)}
+            if method == "POST" and action == "pc_turn":
+                if not isinstance(body.get("text"), str):
+                    raise HTTPError(400, "pc_turn needs a text")
+                return turn_to_dict(await self.manager.pc_turn(session_id, body["text"]))
+            if method == "POST" and action == "npc_turn":
+                return turn_to_dict(await self.manager.npc_turn(session_id))
+        raise HTTPError(404, "no route for {} {}".format(method, path))
+
+
+async def serve(args: argparse.Namespace) -> None:
+    if args.snapshot_dir:
+        os.makedirs(args.snapshot_dir, exist_ok=True)
+    manager = SessionManager(args.scenario, idle_timeout=args.idle_timeout, max_sessions=args.max_sessions, speculate=args.speculate,
+                             snapshot_dir=args.snapshot_dir, graph=DialogueGraph(args.graph) if args.graph else None)
+    server = DialogueServer(manager, args.host, args.port)
+    host, port = await server.start()
+    print("serving on http://{}:{}".format(host, port))
+    try:
+        await server.server.serve_forever()
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--scenario", default="dialogue.json")
+    parser.add_argument("--idle-timeout", type=float, default=600.0)
+    parser.add_argument("--max-sessions", type=int, default=None)
+    parser.add_argument("--speculate", action="store_true")
+    parser.add_argument("--graph", default=None, help="precompiled graph of the scenario, see precompile.py")
+    parser.add_argument("--snapshot-dir", default=None, help="page idle sessions out to this directory instead of dropping them")
+    parser.add_argument("--mock", action="store_true", help="answer from MockBackend instead of the openai api")
+    args = parser.parse_args()
+
+    if args.mock:
+        llm.set_backend(MockBackend())
+    asyncio.run(serve(args))
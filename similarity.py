@@ -0,0 +1,90 @@
+from typing import Dict, List, Optional, Tuple
+import re
+import zlib
+import numpy as np
+
+
+class SimilarityIndex:
+    def __init__(self, texts: List[str], ngram: int = 3, dim: int = 4096):
+        self.ngram: int = ngram
+        self.dim: int = dim
+        self.texts: List[str] = list(texts)
+        self.positions: Dict[str, int] = {text: i for i, text in enumerate(self.texts)}
+        self.vectors: np.ndarray = self.vectorize(self.texts)
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+    def vectorize(self, texts: List[str]) -> np.ndarray:
+        # hashed character n-grams, crc32 keeps the buckets stable across processes
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            text = " {} ".format(self.normalize(text))
+            grams = [text[j:j + self.ngram] for j in range(max(len(text) - self.ngram + 1, 1))]
+            buckets = [zlib.crc32(gram.encode("utf-8")) % self.dim for gram in grams]
+            vectors[i] = np.bincount(buckets, minlength=self.dim)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def scores(self, text: str, targets: List[str] = None) -> np.ndarray:
+        vectors = self.vectors
+        if targets is not None:
+            missing = [target for target in targets if target not in self.positions]
+            if missing:
+                self.add(missing)
+                vectors = self.vectors
+            vectors = vectors[[self.positions[target] for target in targets]]
+        return vectors @ self.vectorize([text])[0]
+
+    def add(self, texts: List[str]) -> None:
+        for text in texts:
+            self.positions[text] = len(self.texts)
+            self.texts.append(text)
+        self.vectors = np.vstack([self.vectors, self.vectorize(texts)])
+
+
+def select_diverse(texts: List[str], k: int, threshold: float = 0.8, keep: List[str] = ()) -> List[str]:
+    # greedily keep texts unlike the ones already kept, topping up with the least similar leftovers if too few pass,
+    # texts in keep count as already chosen and are never returned
+    keep = list(dict.fromkeys(keep))
+    unique = [text for text in dict.fromkeys(text for text in texts if SimilarityIndex.normalize(text)) if text not in keep]
+    if not keep and len(unique) <= 1:
+        return unique[:k]
+    if not unique:
+        return []
+    candidates = keep + unique
+    vectors = SimilarityIndex(candidates).vectors
+    similarity = vectors @ vectors.T
+    selected = list(range(len(keep))) or [len(keep)]
+    for i in range(len(keep), len(candidates)):
+        if len(selected) - len(keep) < k and i not in selected and similarity[i, selected].max() < threshold:
+            selected.append(i)
+    leftovers = [i for i in range(len(keep), len(candidates)) if i not in selected and similarity[i, selected].max() < 0.999]
+    leftovers.sort(key=lambda i: similarity[i, selected].max())
+    selected += leftovers[:k - (len(selected) - len(keep))]
+    return [candidates[i] for i in selected[len(keep):]]
+
+
+class TalkingPointFilter:
+    def __init__(self, targets: List[str], accept: float = 0.95, reject: float = 0.2, margin: float = 0.05):
+        self.index: SimilarityIndex = SimilarityIndex(targets)
+        self.accept: float = accept
+        self.margin: float = margin
+        self.reject: float = reject
+        self.stats: Dict[str, int] = {"accepted": 0, "rejected": 0, "judged": 0}
+
+    def screen(self, text: str, targets: List[str]) -> Tuple[Optional[str], List[str]]:
+        # returns a target decided locally, or the ambiguous targets that still need the llm judge
+        if not targets:
+            return None, []
+        scores = self.index.scores(text, targets)
+        best = int(np.argmax(scores))
+        # a local accept needs a near verbatim line that is also clearly closer to one target than to the rest
+        runner_up = np.partition(scores, -2)[-2] if len(scores) > 1 else 0.0
+        if scores[best] >= self.accept and scores[best] - runner_up >= self.margin:
+            self.stats["accepted"] += 1
+            return targets[best], []
+        ambiguous = [target for target, score in zip(targets, scores) if score >= self.reject]
+        self.stats["judged" if ambiguous else "rejected"] += 1
+        return None, ambiguous
@@ -0,0 +1,264 @@
+from __future__ import annotations
+from typing import Any, Dict, Iterator, List, Optional, Tuple, TYPE_CHECKING
+if TYPE_CHECKING:
+    from graph import DialogueGraph
+import os
+import json
+import zlib
+import struct
+
+from character import Character, CharacterState
+from dialogue import Dialogue, DialogueTurn, TalkingPoint
+from mcts import MCTS, MCTSNode
+from similarity import TalkingPointFilter
+from value import ValueEstimator, from_config, get_config
+
+
+# a snapshot is a header followed by zlib compressed json records, later saves only append what is new
+MAGIC = b"MCTSNAP"
+VERSION = 1
+HEADER = struct.Struct("<7sB")
+RECORD = struct.Struct("<BI")
+SCENARIO, TURN, PROGRESS, TREE = 1, 2, 3, 4
+
+
+def encode_state(state: CharacterState) -> List[Any]:
+    return [state.attitude.value if state.attitude is not None else None, [[char.name, relation.value] for char, relation in state.relations]]
+
+
+def decode_state(data: List[Any], characters: Dict[str, Character]) -> CharacterState:
+    return CharacterState(data[0], [(characters[name], relation) for name, relation in data[1]])
+
+
+def pack_record(kind: int, payload: Any) -> bytes:
+    data = zlib.compress(json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+    return RECORD.pack(kind, len(data)) + data
+
+
+def read_records(path: str) -> Iterator[Tuple[int, bytes]]:
+    # yields each record kind with its raw bytes, decode the payload with unpack_record
+    with open(path, "rb") as file:
+        magic, version = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("{} is not a dialogue snapshot".format(path))
+        if version != VERSION:
+            raise ValueError("snapshot version {} is not supported, expected {}".format(version, VERSION))
+        while True:
+            head = file.read(RECORD.size)
+            if len(head) < RECORD.size:
+                # a torn final record from an interrupted save is dropped
+                return
+            kind, length = RECORD.unpack(head)
+            data = file.read(length)
+            if len(data) < length:
+                return
+            yield kind, head + data
+
+
+def unpack_record(record: bytes) -> Any:
+    return json.loads(zlib.decompress(record[RECORD.size:]))
+
+
+def encode_scenario(dialogue: Dialogue) -> Dict[str, Any]:
+    return {
+        "pc": {"name": dialogue.pc.name, "bio": dialogue.pc.bio},
+        "npcs": [{"name": npc.name, "bio": npc.bio} for npc in dialogue.npcs],
+        "talking_points": [
+            {
+                "character": tp.character.name,
+                "order": tp.order,
+                "description": tp.description,
+                "points": [[text, encode_state(state)] for text, state in tp.text_effects.items()],
+            }
+            for tp in dialogue.talking_points
+        ],
+    }
+
+
+def encode_turn(turn: DialogueTurn, previous: Optional[DialogueTurn]) -> List[Any]:
+    # only the states that changed since the previous turn are stored
+    before = previous.state if previous is not None else {}
+    changed = {char.name: encode_state(state) for char, state in turn.state.items() if before.get(char) != state}
+    return [turn.character.name, turn.text, changed]
+
+
+def encode_settings(settings: Dict[str, Any]) -> Dict[str, Any]:
+    # an estimator instance is stored as its config, names and plain values are stored as they are
+    if isinstance(settings.get("estimator"), ValueEstimator):
+        return dict(settings, estimator=get_config(settings["estimator"]))
+    return settings
+
+
+def decode_settings(settings: Dict[str, Any]) -> Dict[str, Any]:
+    if isinstance(settings.get("estimator"), dict):
+        return dict(settings, estimator=from_config(settings["estimator"]))
+    return settings
+
+
+def encode_progress(dialogue: Dialogue) -> Dict[str, Any]:
+    return {
+        "states": {char.name: encode_state(char.state) for char in dialogue.characters},
+        "talking_points": [tp.targets[0] for tp in dialogue.talking_points],
+        "last_options": dialogue.last_options,
+        "summary": dialogue.summary,
+        "summarized_turns": dialogue.summarized_turns,
+        "search_settings": encode_settings(dialogue.search_settings),
+        "max_player_options": dialogue.max_player_options,
+        "max_history_tokens": dialogue.max_history_tokens,
+        "keep_turns": dialogue.keep_turns,
+        "batch_state_update": dialogue.batch_state_update,
+        "tree": dialogue.mcts is not None,
+        "fingerprint": dialogue.fingerprint,
+        "graph_position": dialogue.graph_position,
+        "graph_edge": dialogue.graph_edge,
+        "speculated_npc_turn": dialogue.speculated_npc_turn,
+    }
+
+
+def encode_tree(mcts: MCTS) -> Dict[str, Any]:
+    # preorder rows of [parent, character, text, visits, reward, done, talking point] along the owning parents,
+    # merged transpositions are stored as extra [parent, child] links
+    nodes, links, indices, stack = [], [], {}, [(mcts.root, -1)]
+    while stack:
+        node, parent = stack.pop()
+        index = len(nodes)
+        indices[id(node)] = index
+        nodes.append([
+            parent,
+            node.character.name if node.character else None,
+            node.text,
+            node.visits,
+            node.reward,
+            node.done,
+            [node.talking_point[0].name, node.talking_point[1]] if node.talking_point else None,
+        ])
+        stack.extend((child, index) for child in reversed(node.children) if child.parent is node)
+    stack = [mcts.root]
+    while stack:
+        node = stack.pop()
+        for position, child in enumerate(node.children):
+            if child.parent is node:
+                stack.append(child)
+            else:
+                links.append([indices[id(node)], indices[id(child)], position])
+    return {"is_pc": mcts.is_pc, "nodes": nodes, "links": links}
+
+
+def decode_tree(data: Dict[str, Any], dialogue: Dialogue, characters: Dict[str, Character]) -> MCTS:
+    mcts = MCTS(dialogue, is_pc=data["is_pc"], **dialogue.search_settings)
+    nodes: List[MCTSNode] = []
+    for parent, name, text, visits, reward, done, talking_point in data["nodes"]:
+        if parent < 0:
+            node = mcts.root
+        else:
+            character = characters[name]
+            node = MCTSNode(None, dialogue.npcs if character == dialogue.pc else [dialogue.pc], nodes[parent], character=character, text=text)
+            nodes[parent].children.append(node)
+        node.visits, node.reward, node.done = visits, reward, done
+        node.talking_point = (characters[talking_point[0]], talking_point[1]) if talking_point else None
+        nodes.append(node)
+    for parent, child, position in sorted(data.get("links", []), key=lambda link: link[2]):
+        nodes[parent].children.insert(position, nodes[child])
+    mcts.rebuild_table()
+    return mcts
+
+
+def save(dialogue: Dialogue, path: str, include_tree: bool = False) -> None:
+    # appends to the snapshot this dialogue was last saved to or restored from, otherwise starts a new file,
+    # a save with nothing new writes nothing and the file is compacted once superseded records outweigh the live ones
+    tail = pack_record(PROGRESS, encode_progress(dialogue))
+    if include_tree and dialogue.mcts is not None:
+        tail += pack_record(TREE, encode_tree(dialogue.mcts))
+    append = dialogue.snapshot_path == path and os.path.exists(path) and dialogue.snapshot_turns <= len(dialogue.turns)
+    if append and dialogue.snapshot_turns == len(dialogue.turns) and tail == dialogue.snapshot_tail:
+        return
+    first = dialogue.snapshot_turns if append else 0
+    turns = b"".join(
+        pack_record(TURN, encode_turn(dialogue.turns[i], dialogue.turns[i - 1] if i > 0 else None))
+        for i in range(first, len(dialogue.turns))
+    )
+    stale = dialogue.snapshot_stale + len(dialogue.snapshot_tail) if append else 0
+    if append and 2 * stale > os.path.getsize(path) + len(turns) + len(tail):
+        append, stale = False, 0
+    if append:
+        with open(path, "ab") as file:
+            file.write(turns + tail)
+    else:
+        # a rewrite goes through a temporary file so an interrupted save never loses the previous snapshot
+        data = HEADER.pack(MAGIC, VERSION) + pack_record(SCENARIO, encode_scenario(dialogue)) + b"".join(
+            pack_record(TURN, encode_turn(turn, dialogue.turns[i - 1] if i > 0 else None)) for i, turn in enumerate(dialogue.turns)
+        ) + tail
+        with open(path + ".tmp", "wb") as file:
+            file.write(data)
+        os.replace(path + ".tmp", path)
+    dialogue.snapshot_path = path
+    dialogue.snapshot_turns = len(dialogue.turns)
+    dialogue.snapshot_tail = tail
+    dialogue.snapshot_stale = stale
+
+
+def restore(path: str, graph: DialogueGraph = None) -> Dialogue:
+    # pass the graph the dialogue was using to carry on from the same position, the graph is not part of the snapshot
+    dialogue = Dialogue()
+    characters: Dict[str, Character] = {}
+    turns: List[List[Any]] = []
+    progress, tree = None, None
+    tail, superseded = b"", 0
+    for kind, record in read_records(path):
+        payload = unpack_record(record)
+        if kind == SCENARIO:
+            dialogue.pc = Character(payload["pc"]["name"], payload["pc"]["bio"])
+            dialogue.npcs = [Character(npc["name"], npc["bio"]) for npc in payload["npcs"]]
+            characters = {char.name: char for char in dialogue.characters}
+            dialogue.talking_points = [
+                TalkingPoint(characters[tp["character"]], tp["order"], tp["description"],
+                             {text: decode_state(state, characters) for text, state in tp["points"]})
+                for tp in payload["talking_points"]
+            ]
+            dialogue.prefilter = TalkingPointFilter([text for tp in dialogue.talking_points for text in tp.targets])
+        elif kind == TURN:
+            turns.append(payload)
+        elif kind == PROGRESS:
+            progress, tree = payload, None
+            superseded += len(tail)
+            tail = record
+        elif kind == TREE:
+            tree = payload
+            tail += record
+    if progress is None:
+        raise ValueError("{} holds no complete snapshot".format(path))
+
+    # replaying the turns rebuilds the formatted history exactly as it was written
+    state: Dict[Character, CharacterState] = {}
+    for name, text, changed in turns:
+        state = dict(state)
+        state.update({characters[char]: decode_state(data, characters) for char, data in changed.items()})
+        dialogue.add_turn(DialogueTurn(characters[name], text, state))
+
+    for name, data in progress["states"].items():
+        characters[name].state = decode_state(data, characters)
+    remaining = set(progress["talking_points"])
+    dialogue.talking_points = [tp for tp in dialogue.talking_points if tp.targets[0] in remaining]
+    dialogue.last_options = progress["last_options"]
+    dialogue.summary = progress["summary"]
+    dialogue.summarized_turns = progress["summarized_turns"]
+    dialogue.search_settings = decode_settings(progress["search_settings"])
+    dialogue.max_player_options = progress["max_player_options"]
+    dialogue.max_history_tokens = progress["max_history_tokens"]
+    dialogue.keep_turns = progress["keep_turns"]
+    dialogue.batch_state_update = progress["batch_state_update"]
+    dialogue.fingerprint = progress.get("fingerprint")
+    # a committed speculation already holds the npc reply, so take_npc_turn must not search for another
+    dialogue.speculated_npc_turn = progress.get("speculated_npc_turn", False)
+    if graph is not None and graph.fingerprint == dialogue.fingerprint:
+        dialogue.use_graph(graph)
+        dialogue.graph_position = progress.get("graph_position")
+        dialogue.graph_edge = progress.get("graph_edge")
+    dialogue.dialogue_prompt = None
+    if progress["tree"] and tree is not None:
+        dialogue.mcts = decode_tree(tree, dialogue, characters)
+    dialogue.snapshot_path = path
+    dialogue.snapshot_turns = len(dialogue.turns)
+    dialogue.snapshot_tail = tail
+    dialogue.snapshot_stale = superseded
+    return dialogue
@@ -0,0 +1,141 @@
+from typing import Any, Dict, List, Optional
+import json
+import time
+
+
+class Histogram:
+    bounds: List[float] = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf")]
+
+    def __init__(self):
+        self.counts: List[int] = [0] * len(self.bounds)
+        self.count: int = 0
+        self.total: float = 0.0
+        self.max: float = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[next(i for i, bound in enumerate(self.bounds) if value <= bound)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        # upper bound of the bucket holding the quantile
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= target and count:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "max": self.max,
+            "buckets": {str(bound): count for bound, count in zip(self.bounds, self.counts)},
+        }
+
+
+class SiteStats:
+    def __init__(self):
+        self.calls: int = 0
+        self.cached: int = 0
+        self.retries: int = 0
+        self.errors: int = 0
+        self.prompt_tokens: int = 0
+        self.completion_tokens: int = 0
+        self.latency: Histogram = Histogram()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "cached": self.cached,
+            "retries": self.retries,
+            "errors": self.errors,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "latency": self.latency.to_dict(),
+        }
+
+
+class Telemetry:
+    def __init__(self, enabled: bool = False, keep_events: bool = True):
+        self.enabled: bool = enabled
+        self.keep_events: bool = keep_events
+        self.reset()
+
+    def reset(self) -> None:
+        self.origin: float = time.perf_counter()
+        self.sites: Dict[str, SiteStats] = {}
+        self.searches: List[Dict[str, Any]] = []
+        self.events: List[Dict[str, Any]] = []
+
+    def record_call(self, site: Optional[str], start: float, latency: float, usage: Dict[str, int] = None, retries: int = 0,
+                    cached: bool = False, error: Exception = None) -> None:
+        if not self.enabled:
+            return
+        site = site or "other"
+        stats = self.sites.setdefault(site, SiteStats())
+        stats.calls += 1
+        stats.cached += cached
+        stats.retries += retries
+        stats.errors += error is not None
+        if usage:
+            stats.prompt_tokens += usage.get("prompt_tokens", 0)
+            stats.completion_tokens += usage.get("completion_tokens", 0)
+        stats.latency.observe(latency)
+        if self.keep_events:
+            self.events.append({
+                "type": "llm_call",
+                "site": site,
+                "start": start - self.origin,
+                "latency": latency,
+                "retries": retries,
+                "cached": cached,
+                "error": repr(error) if error is not None else None,
+                "tokens": usage.get("total_tokens", 0) if usage else 0,
+            })
+
+    def record_search(self, stats: Dict[str, Any]) -> None:
+        if not self.enabled:
+            return
+        stats = dict(stats, start=stats["start"] - self.origin)
+        self.searches.append(stats)
+        if self.keep_events:
+            self.events.append(dict(stats, type="search"))
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "sites": {site: stats.to_dict() for site, stats in self.sites.items()},
+            "searches": len(self.searches),
+        }
+
+    def export_jsonl(self, path: str) -> None:
+        with open(path, "w") as file:
+            for event in self.events:
+                file.write(json.dumps(event) + "\n")
+            file.write(json.dumps(dict(self.summary(), type="summary")) + "\n")
+
+    def export_trace(self, path: str) -> None:
+        # chrome trace event format, open with chrome://tracing or perfetto
+        events = []
+        for event in self.events:
+            if event["type"] == "llm_call":
+                name, category, duration = event["site"], "llm", event["latency"]
+            else:
+                name, category, duration = "search", "mcts", event["duration"]
+            events.append({
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": event["start"] * 1e6,
+                "dur": duration * 1e6,
+                "pid": 0,
+                "tid": name,
+                "args": {key: value for key, value in event.items() if key not in ("type", "start")},
+            })
+        with open(path, "w") as file:
+            json.dump({"traceEvents": events}, file)
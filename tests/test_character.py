@@ -0,0 +1,16 @@
+import copy
+import pickle
+
+from character import Attitude, CharacterState, Relation
+from dialogue import Dialogue
+
+
+def test_state_survives_copy_deepcopy_and_pickle():
+    dialogue = Dialogue()
+    dialogue.load("dialogue.json")
+    state = dialogue.npcs[0].state.replace(Attitude.HAPPY, {dialogue.pc: Relation.ROMANTIC})
+    assert copy.copy(state) is state
+    assert copy.deepcopy(state) is state
+    assert pickle.loads(pickle.dumps(state)) == state
+    assert copy.deepcopy(dialogue).npcs[0].state == dialogue.npcs[0].state
+    assert pickle.loads(pickle.dumps(dialogue.npcs[0])).state == dialogue.npcs[0].state
@@ -0,0 +1,148 @@
+import time
+import asyncio
+import pytest
+
+import openai
+
+import llm
+from backends import Backend, OpenAIBackend
+from client import CircuitBreaker, CircuitOpenError, RateLimiter, RetryPolicy
+from benchmarks.fake_endpoint import FakeEndpoint
+
+
+@pytest.fixture
+def endpoint(monkeypatch):
+    endpoint = FakeEndpoint(latency=0.01)
+    monkeypatch.setattr(llm, "backend", OpenAIBackend(api_key="unused", api_base=endpoint.start()))
+    monkeypatch.setattr(llm, "response_cache", None)
+    monkeypatch.setattr(llm, "rate_limiter", None)
+    monkeypatch.setattr(llm, "retry_policy", RetryPolicy(max_tries=4, base_delay=0.01, max_delay=0.05))
+    monkeypatch.setattr(llm, "circuit_breaker", CircuitBreaker(failure_threshold=3, reset_timeout=0.2))
+    yield endpoint
+    endpoint.stop()
+
+
+def ask(i: int = 0, **kwargs) -> "asyncio.Future":
+    return llm.get_response_async([dict(role="user", content="request {}".format(i))], **kwargs)
+
+
+def test_retries_transient_errors_with_backoff(endpoint):
+    endpoint.fail_next(2, status=503)
+    assert llm.run(ask()).startswith("Fake: reply")
+    assert endpoint.stats["requests"] == 3
+    assert endpoint.stats["errors"] == 2
+    assert llm.circuit_breaker.state == "closed"
+
+
+def test_gives_up_after_max_tries(endpoint):
+    endpoint.fail_next(10)
+    with pytest.raises(RuntimeError, match="Failed to get response"):
+        llm.run(ask(max_tries=2))
+    assert endpoint.stats["requests"] == 2
+
+
+def test_circuit_opens_fails_fast_and_recovers(endpoint):
+    endpoint.fail_next(3)
+    for i in range(3):
+        with pytest.raises(RuntimeError):
+            llm.run(ask(i, max_tries=1))
+    assert llm.circuit_breaker.state == "open"
+
+    # while open nothing reaches the endpoint
+    with pytest.raises(CircuitOpenError):
+        llm.run(ask())
+    assert endpoint.stats["requests"] == 3
+
+    time.sleep(0.25)
+    assert llm.circuit_breaker.state == "half-open"
+
+    # one trial probes the endpoint and the concurrent callers wait for it instead of failing
+    async def burst():
+        return await asyncio.gather(*[ask(i) for i in range(3)], return_exceptions=True)
+    results = llm.run(burst())
+    assert all(isinstance(result, str) for result in results)
+    assert llm.circuit_breaker.state == "closed"
+
+
+def test_failed_trial_reopens_circuit(endpoint):
+    endpoint.fail_next(4)
+    for i in range(3):
+        with pytest.raises(RuntimeError):
+            llm.run(ask(i, max_tries=1))
+    time.sleep(0.25)
+
+    async def burst():
+        return await asyncio.gather(*[ask(i, max_tries=1) for i in range(3)], return_exceptions=True)
+    results = llm.run(burst())
+    # only the trial reached the endpoint, the callers waiting on it see the reopened circuit
+    assert endpoint.stats["requests"] == 4
+    assert [type(result) for result in results].count(CircuitOpenError) == 2
+    assert llm.circuit_breaker.state == "open"
+
+
+def open_circuit(endpoint) -> None:
+    endpoint.fail_next(3)
+    for i in range(3):
+        with pytest.raises(RuntimeError):
+            llm.run(ask(i, max_tries=1))
+    time.sleep(0.25)
+    assert llm.circuit_breaker.state == "half-open"
+
+
+def test_trial_cancelled_while_rate_limited_is_abandoned(endpoint):
+    open_circuit(endpoint)
+    llm.rate_limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=10 ** 9)
+    llm.rate_limiter.requests.tokens = -5
+
+    async def scenario():
+        trial = asyncio.ensure_future(ask(0))
+        await asyncio.sleep(0.05)
+        assert llm.circuit_breaker.trial
+        trial.cancel()
+        await asyncio.gather(trial, return_exceptions=True)
+        llm.rate_limiter = None
+        # the next caller becomes the trial instead of waiting on one that will never finish
+        return await asyncio.wait_for(ask(1), 2)
+    assert llm.run(scenario()).startswith("Fake: reply")
+    assert llm.circuit_breaker.state == "closed"
+
+
+class ContextLengthBackend(Backend):
+    async def complete(self, messages, model, temperature, stop, **kwargs):
+        raise openai.error.InvalidRequestError("This model's maximum context length is 16385 tokens", None)
+
+
+def test_trial_rejected_for_context_length_is_abandoned(endpoint):
+    open_circuit(endpoint)
+    backend = llm.backend
+    llm.backend = ContextLengthBackend()
+    with pytest.raises(llm.ContextLengthError):
+        llm.run(ask())
+    assert not llm.circuit_breaker.trial
+    llm.backend = backend
+    assert llm.run(asyncio.wait_for(ask(1), 2)).startswith("Fake: reply")
+
+
+def test_deadline_bounds_retries(endpoint):
+    endpoint.fail_next(100)
+    llm.retry_policy.base_delay = llm.retry_policy.max_delay = 1.0
+    llm.circuit_breaker.failure_threshold = 10 ** 6
+    start = time.perf_counter()
+    with pytest.raises(asyncio.TimeoutError):
+        llm.run(ask(deadline=0.3, max_tries=100))
+    assert time.perf_counter() - start < 1.0
+
+
+def test_deadline_bounds_slow_responses(endpoint):
+    endpoint.latency = 1.0
+    start = time.perf_counter()
+    with pytest.raises(asyncio.TimeoutError):
+        llm.run(ask(deadline=0.2))
+    assert time.perf_counter() - start < 0.9
+
+
+def test_requests_share_one_connection_pool(endpoint):
+    async def sequence():
+        return [await ask(i) for i in range(5)]
+    assert len(llm.run(sequence())) == 5
+    assert endpoint.stats["connections"] == 1
@@ -0,0 +1,73 @@
+import pytest
+
+from dialogue import Dialogue
+from mcts import MCTS, MCTSNode
+
+
+@pytest.fixture
+def mcts():
+    dialogue = Dialogue()
+    dialogue.load("dialogue.json")
+    return MCTS(dialogue)
+
+
+@pytest.mark.parametrize("answer, expected", [
+    ("Match: 1", 0),
+    ("**Match:** 1", 0),
+    ("Match: #1", 0),
+    ("Match: Target 1", 0),
+    ("Match: target text 1.", 0),
+    ("Match: none", -1),
+    ("**Match:** None", -1),
+    ("Match: 0", -1),
+    ("Match: 7", None),
+    ("none", -1),
+    ("I am not sure.", None),
+])
+def test_parse_match_formats(mcts, answer, expected):
+    assert mcts.parse_match(answer, ["Alice: Do you have a date for the dance?"]) == expected
+
+
+def test_parse_match_prefers_the_explicit_answer_over_echoed_targets(mcts):
+    talking_points = ["Alice: Do you have a date for the dance?"]
+    assert mcts.parse_match('Match: none, the output is not "Do you have a date for the dance?"', talking_points) == -1
+    assert mcts.parse_match('The output says "Do you have a date for the dance?"', talking_points) == 0
+
+
+def test_prune_drops_dominated_children_only():
+    dialogue = Dialogue()
+    dialogue.load("dialogue.json")
+    mcts = MCTS(dialogue, prune_dominated=True, prune_min_visits=3)
+    root = mcts.root
+    children = []
+    for text, visits, reward in [("strong", 20, 18.0), ("weak", 20, 2.0), ("young", 2, 0.0)]:
+        child = MCTSNode(None, [dialogue.pc], root, character=dialogue.npcs[0], text=text)
+        child.visits, child.reward = visits, reward
+        root.children.append(child)
+        children.append(child)
+    root.visits = 42
+
+    mcts.prune(root)
+    strong, weak, young = children
+    # weak's upper bound sits below strong's lower bound, young has too few visits to judge
+    assert weak.pruned
+    assert not strong.pruned and not young.pruned
+    assert mcts.policy_stats["pruned"] == 1
+    for _ in range(5):
+        assert mcts.select()[1] is not weak
+
+    mcts.prune(root)
+    assert mcts.policy_stats["pruned"] == 1
+
+
+def test_prune_keeps_close_children():
+    dialogue = Dialogue()
+    dialogue.load("dialogue.json")
+    mcts = MCTS(dialogue, prune_dominated=True)
+    for text, reward in [("a", 6.0), ("b", 5.0)]:
+        child = MCTSNode(None, [dialogue.pc], mcts.root, character=dialogue.npcs[0], text=text)
+        child.visits, child.reward = 10, reward
+        mcts.root.children.append(child)
+    mcts.root.visits = 20
+    mcts.prune(mcts.root)
+    assert not any(child.pruned for child in mcts.root.children)
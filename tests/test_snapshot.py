@@ -0,0 +1,19 @@
+import llm
+import snapshot
+from backends import MockBackend
+from dialogue import Dialogue
+from value import HybridEstimator, make_estimator
+
+
+def test_estimator_instance_in_search_settings_round_trips(tmp_path, monkeypatch):
+    monkeypatch.setattr(llm, "backend", MockBackend())
+    monkeypatch.setattr(llm, "rate_limiter", None)
+    dialogue = Dialogue()
+    dialogue.load("dialogue.json")
+    dialogue.search_settings = dict(max_iterations=5, estimator=make_estimator("hybrid", top_k=3))
+    path = str(tmp_path / "dialogue.snap")
+    snapshot.save(dialogue, path)
+    restored = snapshot.restore(path).search_settings["estimator"]
+    assert isinstance(restored, HybridEstimator)
+    assert restored.top_k == 3
+    assert list(restored.local.weights) == list(dialogue.search_settings["estimator"].local.weights)
@@ -0,0 +1,152 @@
+from __future__ import annotations
+from typing import Any, Dict, List, Optional, Union, TYPE_CHECKING
+if TYPE_CHECKING:
+    from mcts import MCTS, MCTSNode
+import json
+import numpy as np
+
+from similarity import SimilarityIndex
+
+
+class ValueEstimator:
+    name: str = "base"
+
+    def reset(self) -> None:
+        # called at the start of every search
+        pass
+
+    async def estimate(self, mcts: MCTS, node: MCTSNode) -> float:
+        raise NotImplementedError
+
+
+def get_features(mcts: MCTS, node: MCTSNode, index: SimilarityIndex, context_lines: int = 3) -> List[float]:
+    # closeness of the line and of the recent dialogue to the pending talking points, and how deep the node is
+    targets = [tp.split(":", 1)[-1].strip() for tp in mcts.talking_points]
+    if not targets:
+        return [0.0, 0.0, 0.0]
+    context = "\n".join(node.history.split("\n")[-context_lines:])
+    return [
+        float(index.scores(node.text, targets).max()) if node.text else 0.0,
+        float(index.scores(context, targets).max()),
+        float(mcts.get_depth(node)),
+    ]
+
+
+class RolloutEstimator(ValueEstimator):
+    # the llm rollout, optionally logging each outcome with its local features for calibration
+    name = "rollout"
+
+    def __init__(self, log_path: str = None):
+        self.log_path: Optional[str] = log_path
+        self.index: SimilarityIndex = SimilarityIndex([])
+
+    async def estimate(self, mcts: MCTS, node: MCTSNode) -> float:
+        reward = await mcts.rollout(node)
+        if self.log_path is not None:
+            with open(self.log_path, "a") as file:
+                file.write(json.dumps({"features": get_features(mcts, node, self.index), "reward": reward}) + "\n")
+        return reward
+
+
+class SimilarityEstimator(ValueEstimator):
+    # a logistic model over the local features, no llm calls at all
+    name = "similarity"
+
+    def __init__(self, weights: List[float] = (6.0, 3.0, -0.3), bias: float = -4.0):
+        self.weights: np.ndarray = np.array(weights, dtype=np.float64)
+        self.bias: float = bias
+        self.index: SimilarityIndex = SimilarityIndex([])
+
+    def predict(self, features: List[float]) -> float:
+        return float(1 / (1 + np.exp(-(np.dot(self.weights, features) + self.bias))))
+
+    async def estimate(self, mcts: MCTS, node: MCTSNode) -> float:
+        if not mcts.talking_points:
+            return 0.0
+        return self.predict(get_features(mcts, node, self.index))
+
+    def fit(self, log_path: str, epochs: int = 2000, learning_rate: float = 0.5, l2: float = 1e-3) -> SimilarityEstimator:
+        # calibrate against logged rollout rewards, which are discounted 0/1 outcomes used as soft labels
+        with open(log_path, "r") as file:
+            rows = [json.loads(line) for line in file if line.strip()]
+        if not rows:
+            return self
+        x = np.array([row["features"] for row in rows], dtype=np.float64)
+        y = np.array([row["reward"] for row in rows], dtype=np.float64)
+        weights, bias = self.weights.copy(), self.bias
+        for _ in range(epochs):
+            error = 1 / (1 + np.exp(-(x @ weights + bias))) - y
+            weights -= learning_rate * (x.T @ error / len(y) + l2 * weights)
+            bias -= learning_rate * error.mean()
+        self.weights, self.bias = weights, float(bias)
+        return self
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as file:
+            json.dump({"weights": self.weights.tolist(), "bias": self.bias}, file)
+
+    @classmethod
+    def load(cls, path: str) -> SimilarityEstimator:
+        with open(path, "r") as file:
+            data = json.load(file)
+        return cls(data["weights"], data["bias"])
+
+
+class HybridEstimator(ValueEstimator):
+    # scores every leaf locally and spends llm rollouts only on leaves within the top k seen during the search
+    name = "hybrid"
+
+    def __init__(self, local: SimilarityEstimator, rollout: RolloutEstimator, top_k: int = 2):
+        self.local: SimilarityEstimator = local
+        self.rollout: RolloutEstimator = rollout
+        self.top_k: int = top_k
+        self.scores: List[float] = []
+        self.rollouts: int = 0
+
+    def reset(self) -> None:
+        self.scores = []
+        self.rollouts = 0
+
+    async def estimate(self, mcts: MCTS, node: MCTSNode) -> float:
+        score = await self.local.estimate(mcts, node)
+        rank = sum(seen > score for seen in self.scores)
+        self.scores.append(score)
+        if rank < self.top_k:
+            self.rollouts += 1
+            return await self.rollout.estimate(mcts, node)
+        return score
+
+
+def make_estimator(estimator: Union[str, ValueEstimator] = "rollout", log_path: str = None, model_path: str = None,
+                   top_k: int = 2) -> ValueEstimator:
+    if isinstance(estimator, ValueEstimator):
+        return estimator
+    local = SimilarityEstimator.load(model_path) if model_path else SimilarityEstimator()
+    if estimator == "rollout":
+        return RolloutEstimator(log_path)
+    if estimator == "similarity":
+        return local
+    if estimator == "hybrid":
+        return HybridEstimator(local, RolloutEstimator(log_path), top_k)
+    raise ValueError("unknown value estimator {!r}, expected rollout, similarity or hybrid".format(estimator))
+
+
+def get_config(estimator: ValueEstimator) -> Dict[str, Any]:
+    # a json description of a built in estimator, so search settings holding an instance can be snapshotted
+    if type(estimator) is RolloutEstimator:
+        return {"name": "rollout", "log_path": estimator.log_path}
+    if type(estimator) is SimilarityEstimator:
+        return {"name": "similarity", "weights": estimator.weights.tolist(), "bias": estimator.bias}
+    if type(estimator) is HybridEstimator:
+        return {"name": "hybrid", "local": get_config(estimator.local), "rollout": get_config(estimator.rollout), "top_k": estimator.top_k}
+    raise ValueError("{} cannot be saved, configure the search with an estimator name instead".format(type(estimator).__name__))
+
+
+def from_config(config: Dict[str, Any]) -> ValueEstimator:
+    if config["name"] == "rollout":
+        return RolloutEstimator(config["log_path"])
+    if config["name"] == "similarity":
+        return SimilarityEstimator(config["weights"], config["bias"])
+    if config["name"] == "hybrid":
+        return HybridEstimator(from_config(config["local"]), from_config(config["rollout"]), config["top_k"])
+    raise ValueError("unknown value estimator {!r}, expected rollout, similarity or hybrid".format(config["name"]))